@@ -1,52 +1,229 @@
+import difflib
 import logging
-from langchain.chat_models import ChatAnthropic
+import re
+from dataclasses import dataclass
+from typing import Dict, Optional, Union
 from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate
 from dotenv import load_dotenv
 from utils import save_output
-import xml.etree.ElementTree as ET
+from llm_cache import LLMCache, make_key
+from embedding import count_tokens
+from instrumentation import metrics
+from artifact_store import ArtifactRun
+from rate_limit import rate_limits
+from backends import BACKEND, CHAT_MODEL, CHAT_TEMPERATURE, CHAT_MAX_TOKENS, get_chat_model, uses_cassette
+from streaming import ANSWER_OPEN, StreamingOutputHandler, extract_answer
 
 load_dotenv()
 
-from templates import INITIAL_CRITIQUE_PAGE_TEMPLATE, IMPROVE_PAGE_TEMPLATE, CRITIQUE_PAGE_TEMPLATE
+from templates import INITIAL_CRITIQUE_PAGE_TEMPLATE, IMPROVE_PAGE_TEMPLATE, CRITIQUE_PAGE_TEMPLATE, TEMPLATES
 
 logger = logging.getLogger(__name__)
 
-chat = ChatAnthropic(model='claude-2', temperature=0, max_tokens_to_sample=8192)
+# Claude by default; DOCIFY_BACKEND selects a recording, replaying or stub model instead
+chat = get_chat_model()
+# Same model, but tokens are passed to callbacks as they are generated
+streaming_chat = get_chat_model(streaming=True)
+llm_cache = LLMCache()
 
-def get_answer(response: str):
-    root = ET.fromstring(f'<root>{response}</root>')
+TEMPLATE_NAMES = {template: name for name, template in TEMPLATES.items()}
+
+
+def model_settings() -> dict:
+    return {
+        # Stub responses must never be mistaken for real ones in the caches or the manifest
+        "model": "stub" if BACKEND == "stub" else CHAT_MODEL,
+        "temperature": CHAT_TEMPERATURE,
+        "max_tokens_to_sample": CHAT_MAX_TOKENS,
+    }
+
+
+def run_chain(template: str, stream_handler: Optional[StreamingOutputHandler] = None, **variables) -> str:
+    """Runs an LLMChain for the template, reusing a cached completion for identical prompts.
 
-    # Find the 'answer' tag and get its text
-    answer = root.find('answer').text
+    With a stream_handler the completion is streamed to it as it is generated. The cache
+    is skipped when recording or replaying, so the cassette holds every call of a run.
+    """
+    use_cache = not uses_cassette()
+    settings = model_settings()
+    key = make_key(settings["model"], settings["temperature"], template, variables)
+    prompt = PromptTemplate.from_template(template)
+    with metrics.span(f"chain:{TEMPLATE_NAMES.get(template, 'other')}") as span:
+        span.model = settings["model"]
+        span.input_tokens = count_tokens(prompt.format(**variables))
+        cached = llm_cache.get(key) if use_cache else None
+        if cached is not None:
+            span.cached = True
+            span.output_tokens = count_tokens(cached)
+            return cached
+        llm = streaming_chat if stream_handler is not None else chat
+        chain = LLMChain(llm=llm, prompt=prompt)
+        callbacks = [stream_handler] if stream_handler is not None else None
+        # Waits for a slot in the shared Anthropic request and token budget, retrying on 429s
+        response = rate_limits.limiter("anthropic").call(
+            lambda: chain.run(callbacks=callbacks, **variables), tokens=span.input_tokens
+        )
+        span.output_tokens = count_tokens(response)
+        if stream_handler is not None:
+            span.extra["time_to_first_token"] = stream_handler.time_to_first_token
+    if use_cache:
+        llm_cache.set(key, response)
+    return response
+
+def get_answer(response: str):
+    # Parsed as text rather than XML: Markdown answers often contain a stray '<' or '&',
+    # and an XML parser would stop the answer at the first child element
+    answer = extract_answer(response)
+    if answer is None:
+        if ANSWER_OPEN in response:
+            # Most likely cut off at max_tokens_to_sample, publishing it would lose the rest of the page
+            raise ValueError("The <answer> tag in the response was never closed")
+        raise ValueError("No <answer> tag found in the response")
     return answer
 
 
-def get_improved_page(reference_page: str, context: str, reference_page_name: str, n=2) -> str:
+def get_stream_handler(stream: bool, stage: str, reference_page_name: str, answer_only: bool = False) -> Optional[StreamingOutputHandler]:
+    if not stream:
+        return None
+    return StreamingOutputHandler(
+        stage=f"{stage} {reference_page_name}",
+        partial_path=f"src/output/partial/{stage}/{reference_page_name}.md",
+        extract_answer=answer_only,
+    )
+
+
+def get_stage_context(context: Union[str, Dict[str, str]], stage: str) -> str:
+    """context is either shared by every template or keyed by the names in TEMPLATES."""
+    return context if isinstance(context, str) else context[stage]
+
+
+@dataclass
+class RefinementLimits:
+    # One round is a critique and an improvement, the same two calls as a single pass
+    max_rounds: int = 1
+    # Stop before critiquing a draft that changed less than this fraction of the page
+    min_change: float = 0.02
+    # Stop once a critique reports nothing substantive left to fix
+    stop_on_clean_critique: bool = True
+    # Hard caps per page, None for no limit
+    max_calls: Optional[int] = None
+    max_tokens: Optional[int] = None
+
+
+@dataclass
+class RefinementResult:
+    page: str
+    rounds: int = 0
+    calls: int = 0
+    tokens: int = 0
+    stop_reason: str = ""
+
+
+# Phrases critiques use when the page doesn't need more work. "No major issues" is left out on
+# purpose, it usually comes with a list of minor ones.
+CLEAN_CRITIQUE_PATTERN = re.compile(
+    r"\bno (?:further |other |remaining |additional )?(?:issues|changes|improvements|problems|corrections)\b"
+    r"|(?:does not|doesn't) need (?:any )?(?:further|more) (?:improvements|changes)",
+    re.IGNORECASE,
+)
+# Anything that hints the critique still asks for a change overrides a clean phrase
+CRITIQUE_CAVEAT_PATTERN = re.compile(
+    r"\b(?:however|but|although|though|except|apart from|other than|besides|still|should|could|consider|suggest|recommend|missing|lacks?)\b",
+    re.IGNORECASE,
+)
+
+
+def is_clean_critique(critique: str) -> bool:
+    return CLEAN_CRITIQUE_PATTERN.search(critique) is not None and CRITIQUE_CAVEAT_PATTERN.search(critique) is None
+
+
+def page_change(previous: str, current: str) -> float:
+    """Fraction of the page that changed between two versions, 0 for identical pages."""
+    return 1 - difflib.SequenceMatcher(None, previous, current, autojunk=False).ratio()
+
+
+def estimate_tokens(template: str, variables: dict, response: str) -> int:
+    prompt = PromptTemplate.from_template(template).format(**variables)
+    return count_tokens(prompt) + count_tokens(response)
+
+
+def refine_page(reference_page: str, context: Union[str, Dict[str, str]], reference_page_name: str, limits: Optional[RefinementLimits] = None, stream=False, artifacts: Optional[ArtifactRun] = None) -> RefinementResult:
+    """Critiques and improves a page until it converges or a limit is reached.
+
+    Intermediate outputs go to the artifacts run when given, otherwise to files under src/output.
+    """
+    limits = limits or RefinementLimits()
+    result = RefinementResult(page=reference_page)
+
+    def save(stage, content):
+        if artifacts is not None:
+            artifacts.put(reference_page_name, stage, content)
+        else:
+            save_output(f'src/output/{stage}/{reference_page_name}.md', content)
+
+    def call(template, stream_handler, **variables):
+        response = run_chain(template, stream_handler=stream_handler, **variables)
+        result.calls += 1
+        result.tokens += estimate_tokens(template, variables, response)
+        return response
+
+    def over_budget():
+        if limits.max_calls is not None and result.calls >= limits.max_calls:
+            return "max_calls"
+        if limits.max_tokens is not None and result.tokens >= limits.max_tokens:
+            return "max_tokens"
+        return None
+
     # Step 1: Give initial critique
     logger.info(f'Generating initial critique for {reference_page_name}')        
-    initial_critique_page_chain = LLMChain(llm=chat, prompt=PromptTemplate.from_template(INITIAL_CRITIQUE_PAGE_TEMPLATE))
-    critique = initial_critique_page_chain.run(context=context, reference_page=reference_page)
-    save_output(f'src/output/initial_critique/{reference_page_name}.md', critique)
-    
-    for i in range(1, n+1):            
-        # Step 1: Given context and a reference page, generate an improved page
+    critique = call(INITIAL_CRITIQUE_PAGE_TEMPLATE, get_stream_handler(stream, "initial_critique", reference_page_name), context=get_stage_context(context, "initial_critique"), reference_page=reference_page)
+    save('initial_critique', critique)
+    if limits.stop_on_clean_critique and is_clean_critique(critique):
+        result.stop_reason = "clean_initial_critique"
+        return result
+
+    for i in range(1, limits.max_rounds + 1):
+        result.stop_reason = over_budget()
+        if result.stop_reason:
+            break
+
+        # Step 2: Given context and a reference page, generate an improved page
         logger.info(f'Round {i}: Generating improved page for {reference_page_name}')
-        improve_page_chain = LLMChain(llm=chat, prompt=PromptTemplate.from_template(IMPROVE_PAGE_TEMPLATE))
-        improved_page_xml = improve_page_chain.run(context=context, reference_page=reference_page, critique=critique)
-        save_output(f'src/output/improvement/v{i}/{reference_page_name}.md', improved_page_xml)
+        improved_page_xml = call(IMPROVE_PAGE_TEMPLATE, get_stream_handler(stream, f"improvement/v{i}", reference_page_name, answer_only=True), context=get_stage_context(context, "improve"), reference_page=reference_page, critique=critique)
+        save(f'improvement/v{i}', improved_page_xml)
         improved_page = get_answer(improved_page_xml)
-        
-        if i == n - 1:
+        change = page_change(result.page, improved_page)
+        result.page = improved_page
+        result.rounds = i
+
+        # Checked before spending a critique on a draft that barely moved
+        if change < limits.min_change:
+            result.stop_reason = "converged"
+            break
+        if i == limits.max_rounds:
+            result.stop_reason = "max_rounds"
             break
-        # Step 2: Given the improved page, critique it and provide feedback
+        result.stop_reason = over_budget()
+        if result.stop_reason:
+            break
+
+        # Step 3: Given the improved page, critique it and provide feedback
         logger.info(f'Round {i}: Generating critique for {reference_page_name}')
-        critique_page_chain = LLMChain(llm=chat, prompt=PromptTemplate.from_template(CRITIQUE_PAGE_TEMPLATE))
-        critique = critique_page_chain.run(context=context, reference_page=reference_page, improved_page=improved_page)
-        save_output(f'src/output/final_critique/v{i}/{reference_page_name}.md', critique)
-        
+        critique = call(CRITIQUE_PAGE_TEMPLATE, get_stream_handler(stream, f"final_critique/v{i}", reference_page_name), context=get_stage_context(context, "critique"), reference_page=reference_page, improved_page=improved_page)
+        save(f'final_critique/v{i}', critique)
+        if limits.stop_on_clean_critique and is_clean_critique(critique):
+            result.stop_reason = "clean_critique"
+            break
+
         reference_page = improved_page
 
-    return improved_page
+    logger.info(f'Stopped refining {reference_page_name} after {result.rounds} rounds, {result.calls} calls: {result.stop_reason}')
+    return result
+
+
+def get_improved_page(reference_page: str, context: Union[str, Dict[str, str]], reference_page_name: str, n=2, stream=False) -> str:
+    limits = RefinementLimits(max_rounds=n, min_change=0.0, stop_on_clean_critique=False)
+    return refine_page(reference_page, context, reference_page_name, limits, stream=stream).page
     # TODO: Create a prompt that creates questions based on the reference page.
     # Then we answer these questions using another prompt.
\ No newline at end of file
@@ -0,0 +1,286 @@
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ARTIFACT_PATH = "src/data/artifacts.sqlite"
+FINAL_STAGE = "final"
+# The writer commits once this many pages are queued or flush_interval passes, whichever is first
+WRITE_BATCH_SIZE = 64
+FLUSH_INTERVAL = 0.5
+
+
+def _hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class ArtifactRun:
+    """Collects the outputs of one run. A page's outputs become visible together on commit_page."""
+
+    def __init__(self, store: "ArtifactStore", run_id: str) -> None:
+        self.store = store
+        self.run_id = run_id
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Dict[str, str]] = {}
+
+    def put(self, page: str, stage: str, content: str) -> None:
+        with self._lock:
+            self._pending.setdefault(page, {})[stage] = content
+
+    def commit_page(self, page: str, final_content: str) -> None:
+        """Writes every output of the page, plus its final Markdown, in one transaction.
+
+        Pages from several threads share the writer's batches. Blocks until the page's
+        batch is committed and raises if the write failed, so callers can record the
+        page as done only once it is on disk.
+        """
+        with self._lock:
+            stages = self._pending.pop(page, {})
+        stages[FINAL_STAGE] = final_content
+        written: Future = Future()
+        self.store._enqueue((self.run_id, page, stages, time.time(), written))
+        written.result()
+
+    def discard_page(self, page: str) -> None:
+        with self._lock:
+            self._pending.pop(page, None)
+
+
+class ArtifactStore:
+    """Outputs of every run in one SQLite database, written by a background thread.
+
+    Contents are stored once per distinct text, so unchanged reference pages and
+    critiques repeated across runs take no extra space.
+    """
+
+    def __init__(self, path: str = DEFAULT_ARTIFACT_PATH, batch_size: int = WRITE_BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL) -> None:
+        parent_dir = os.path.dirname(path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                started_at REAL NOT NULL,
+                settings TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                content TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS artifacts (
+                run_id TEXT NOT NULL,
+                page TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                committed_at REAL NOT NULL,
+                PRIMARY KEY (run_id, page, stage)
+            );
+            -- Final Markdown of the most recent run that committed each page
+            CREATE TABLE IF NOT EXISTS latest (
+                page TEXT PRIMARY KEY,
+                run_id TEXT NOT NULL,
+                hash TEXT NOT NULL
+            );
+            """
+        )
+        self._conn.commit()
+        self._queue: "queue.Queue[Optional[Tuple[str, str, Dict[str, str], float, Future]]]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+
+    def start_run(self, settings: Optional[dict] = None) -> ArtifactRun:
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO runs (run_id, started_at, settings) VALUES (?, ?, ?)",
+                (run_id, time.time(), json.dumps(settings or {}, sort_keys=True)),
+            )
+            self._conn.commit()
+        return ArtifactRun(self, run_id)
+
+    def _enqueue(self, item) -> None:
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, daemon=True)
+                self._writer.start()
+        self._queue.put(item)
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Put the sentinel back so the loop exits after this batch
+                    self._queue.task_done()
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} pages to the artifact store: {e}")
+                metrics.count("artifact_write_failures", len(batch))
+                for *_, written in batch:
+                    written.set_exception(e)
+            else:
+                for *_, written in batch:
+                    written.set_result(None)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write_batch(self, batch) -> None:
+        blobs, artifacts, latest = [], [], []
+        for run_id, page, stages, committed_at, _ in batch:
+            for stage, content in stages.items():
+                digest = _hash(content)
+                blobs.append((digest, content))
+                artifacts.append((run_id, page, stage, digest, committed_at))
+                if stage == FINAL_STAGE:
+                    latest.append((page, run_id, digest))
+        with metrics.span("artifact_write", pages=len(batch)), self._lock:
+            # One transaction per batch, so a crash never leaves a page half written
+            with self._conn:
+                self._conn.executemany("INSERT OR IGNORE INTO blobs (hash, content) VALUES (?, ?)", blobs)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO artifacts (run_id, page, stage, hash, committed_at) VALUES (?, ?, ?, ?, ?)",
+                    artifacts,
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO latest (page, run_id, hash) VALUES (?, ?, ?)", latest
+                )
+
+    def flush(self) -> None:
+        """Blocks until every committed page is on disk."""
+        self._queue.join()
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            writer = self._writer
+        if writer is not None and writer.is_alive():
+            self._queue.put(None)
+            writer.join()
+
+    def get(self, page: str, stage: str = FINAL_STAGE, run_id: Optional[str] = None) -> Optional[str]:
+        with self._lock:
+            if run_id is None and stage == FINAL_STAGE:
+                row = self._conn.execute(
+                    "SELECT content FROM latest JOIN blobs USING (hash) WHERE page = ?", (page,)
+                ).fetchone()
+            else:
+                row = self._conn.execute(
+                    "SELECT content FROM artifacts JOIN blobs USING (hash) "
+                    "WHERE page = ? AND stage = ? AND (? IS NULL OR run_id = ?) "
+                    "ORDER BY committed_at DESC LIMIT 1",
+                    (page, stage, run_id, run_id),
+                ).fetchone()
+        return row[0] if row else None
+
+    def runs(self) -> List[Tuple[str, float, int]]:
+        """(run_id, started_at, pages committed) of every run, newest first."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT run_id, started_at, "
+                "(SELECT COUNT(*) FROM artifacts a WHERE a.run_id = runs.run_id AND a.stage = ?) "
+                "FROM runs ORDER BY started_at DESC",
+                (FINAL_STAGE,),
+            ).fetchall()
+
+    def export(self, target_dir: str, run_id: Optional[str] = None, stage: str = FINAL_STAGE) -> List[str]:
+        """Writes each page's Markdown to target_dir/{page}.md, skipping files that already match.
+
+        Exports the latest version of every page, or only the pages of run_id. Returns the pages written.
+        """
+        with self._lock:
+            if run_id is None and stage == FINAL_STAGE:
+                rows = self._conn.execute("SELECT page, hash FROM latest").fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT page, hash FROM artifacts WHERE stage = ? AND (? IS NULL OR run_id = ?) "
+                    "ORDER BY committed_at",
+                    (stage, run_id, run_id),
+                ).fetchall()
+        # Later rows win when a page was committed by several runs
+        hashes = dict(rows)
+
+        written = []
+        with metrics.span("export", pages=len(hashes)):
+            for page, digest in hashes.items():
+                output_path = os.path.join(target_dir, f"{page}.md")
+                if os.path.isfile(output_path):
+                    with open(output_path, encoding="utf-8") as f:
+                        if _hash(f.read()) == digest:
+                            continue
+                with self._lock:
+                    (content,) = self._conn.execute("SELECT content FROM blobs WHERE hash = ?", (digest,)).fetchone()
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                tmp_path = f"{output_path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(content)
+                os.replace(tmp_path, output_path)
+                written.append(page)
+        return written
+
+    def stats(self) -> dict:
+        with self._lock:
+            (runs,) = self._conn.execute("SELECT COUNT(*) FROM runs").fetchone()
+            (artifacts,) = self._conn.execute("SELECT COUNT(*) FROM artifacts").fetchone()
+            (blobs, blob_bytes) = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(content)), 0) FROM blobs").fetchone()
+            (pages,) = self._conn.execute("SELECT COUNT(*) FROM latest").fetchone()
+        return {"runs": runs, "pages": pages, "artifacts": artifacts, "blobs": blobs, "blob_bytes": blob_bytes}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect and export the run artifact store")
+    parser.add_argument("--path", default=DEFAULT_ARTIFACT_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Write changed pages as Markdown files")
+    export_parser.add_argument("--target", default="langdocs/docs/")
+    export_parser.add_argument("--run-id", help="Only export the pages of this run")
+    export_parser.add_argument(
+        "--stage",
+        default=FINAL_STAGE,
+        help="Export another stage instead of the final page, e.g. initial_critique",
+    )
+    subparsers.add_parser("runs", help="List runs")
+    subparsers.add_parser("stats", help="Show store size")
+    args = parser.parse_args()
+
+    store = ArtifactStore(args.path)
+    if args.command == "export":
+        written = store.export(args.target, run_id=args.run_id, stage=args.stage)
+        print(f"Exported {len(written)} changed pages to {args.target}")
+    elif args.command == "runs":
+        for run_id, started_at, pages in store.runs():
+            print(f"{run_id}  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started_at))}  {pages} pages")
+    else:
+        print(store.stats())
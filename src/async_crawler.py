@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Callable, List, Optional, Tuple
+
+import aiohttp
+from tqdm import tqdm
+
+from crawler import WebpageCrawler
+from custom_types import Source, SourceType, Metadata
+from http_cache import HttpCache
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Called with (url, source, error) as each url finishes. Exactly one of source and error is set.
+ResultCallback = Callable[[str, Optional[Source], Optional[Exception]], None]
+
+
+class FetchError(Exception):
+    pass
+
+
+class AsyncWebpageCrawler(WebpageCrawler):
+    """Crawls many pages concurrently over a pooled aiohttp session.
+
+    Transient failures (429/5xx, connection errors) are retried with exponential
+    backoff until the per-url retry limit or the crawl-wide retry budget runs out.
+    """
+
+    def __init__(
+        self,
+        source_type: SourceType,
+        max_connections: int = 32,
+        max_per_host: int = 8,
+        max_retries: int = 4,
+        retry_budget: int = 200,
+        backoff_base: float = 1.0,
+        timeout: float = 30,
+        http_cache: Optional[HttpCache] = None,
+        extraction_backend: str = "html.parser",
+    ) -> None:
+        super().__init__(
+            source_type=source_type,
+            use_unstructured=False,
+            http_cache=http_cache,
+            extraction_backend=extraction_backend,
+        )
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        # Retries allowed per crawl, self.retry_budget counts down from it during a crawl
+        self.max_retry_budget = retry_budget
+        self.retry_budget = retry_budget
+        self.backoff_base = backoff_base
+        self.timeout = timeout
+
+    def _backoff(self, attempt: int, retry_after: Optional[str]) -> float:
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff_base * 2**attempt + random.uniform(0, self.backoff_base)
+
+    async def _fetch_html(self, session: aiohttp.ClientSession, url: str) -> Tuple[str, Optional[str]]:
+        """Returns the page html and, if the page is unchanged, its previously converted markdown."""
+        attempt = 0
+        headers = self.http_cache.conditional_headers(url) if self.http_cache else {}
+        while True:
+            retry_after = None
+            try:
+                async with session.get(url, headers=headers) as response:
+                    if response.status == 304 and self.http_cache is not None:
+                        cached = self.http_cache.mark_unchanged(url)
+                        if cached is not None:
+                            self.unchanged.append(url)
+                            return cached.body, cached.derived
+                        headers = {}
+                        continue
+                    if response.status == 200:
+                        html = await response.text()
+                        if self.http_cache is not None:
+                            self.http_cache.store(url, response.headers, html)
+                        return html, None
+                    if response.status not in RETRY_STATUSES:
+                        raise FetchError(
+                            f"Failed to fetch the webpage. Status code: {response.status}"
+                        )
+                    retry_after = response.headers.get("Retry-After")
+                    error = f"status code {response.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+
+            if attempt >= self.max_retries or self.retry_budget <= 0:
+                raise FetchError(f"Giving up on {url} after {attempt + 1} attempts: {error}")
+            self.retry_budget -= 1
+            delay = self._backoff(attempt, retry_after)
+            logger.info(f"Retrying {url} in {delay:.1f}s ({error})")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _generate_row_async(self, session: aiohttp.ClientSession, url: str) -> Source:
+        html, content = await self._fetch_html(session, url)
+        if content is None:
+            # Parsing is CPU bound, keep it off the event loop
+            loop = asyncio.get_running_loop()
+            content = await loop.run_in_executor(
+                None, lambda: self._html_to_markdown(self._extract_body(html, url))
+            )
+            if self.http_cache is not None:
+                self.http_cache.store_derived(url, content)
+        return Source(
+            url=url,
+            content=content,
+            metadata=Metadata(source_type=self.source_type, fetched_at=time.time()),
+        )
+
+    async def crawl_async(self, urls: List[str], on_result: Optional[ResultCallback] = None) -> Tuple[List[Source], List[str]]:
+        """Crawls urls with a fixed pool of workers.
+
+        If on_result is given it is called as each url finishes and sources are not
+        accumulated, so memory stays flat however many pages are crawled.
+        """
+        # A reused crawler gets a fresh budget, and only reports this crawl's unchanged pages
+        self.retry_budget = self.max_retry_budget
+        self.unchanged = []
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections, limit_per_host=self.max_per_host
+        )
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        sources = []
+        errored = []
+        queue: asyncio.Queue = asyncio.Queue()
+        for url in urls:
+            queue.put_nowait(url)
+        progress = tqdm(total=len(urls))
+
+        def handle_result(url, source, error):
+            if error is not None:
+                errored.append(url)
+                logger.error(f"Error on {url}, {error}")
+            elif on_result is None:
+                sources.append(source)
+            if on_result is not None:
+                on_result(url, source, error)
+            progress.update(1)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+            async def worker():
+                while True:
+                    try:
+                        url = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    try:
+                        source = await self._generate_row_async(session, url)
+                        handle_result(url, source, None)
+                    except Exception as e:
+                        handle_result(url, None, e)
+
+            workers = min(self.max_connections, len(urls))
+            await asyncio.gather(*(worker() for _ in range(workers)))
+        progress.close()
+        logger.info(f"{len(self.unchanged)} of {len(urls)} pages unchanged since the last crawl")
+        return sources, errored
+
+    def crawl(self, urls: List[str], on_result: Optional[ResultCallback] = None) -> Tuple[List[Source], List[str]]:
+        """Returns the crawled sources and the urls that failed."""
+        return asyncio.run(self.crawl_async(urls, on_result))
+
+    def generate_row(self, url: str) -> Source:
+        sources, errored = self.crawl([url])
+        if errored:
+            raise FetchError(f"Failed to crawl {url}")
+        return sources[0]
@@ -0,0 +1,285 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.chat_models import ChatAnthropic
+from langchain.chat_models.base import BaseChatModel
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings.base import Embeddings
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult
+
+from embedding import count_tokens
+from rate_limit import rate_limits
+
+logger = logging.getLogger(__name__)
+
+# live: call the providers. record: call the providers and save every response to the cassette.
+# replay: serve responses from the cassette only. stub: canned responses, no cassette needed.
+BACKENDS = ("live", "record", "replay", "stub")
+BACKEND = os.getenv("DOCIFY_BACKEND", "live")
+CASSETTE_PATH = os.getenv("DOCIFY_CASSETTE", "src/data/cassette.jsonl")
+# Multiplier on recorded latencies when replaying, 0 serves responses immediately
+REPLAY_LATENCY_SCALE = float(os.getenv("DOCIFY_REPLAY_LATENCY_SCALE", "1.0"))
+STUB_LATENCY = float(os.getenv("DOCIFY_STUB_LATENCY", "0.5"))
+
+CHAT_MODEL = "claude-2"
+CHAT_TEMPERATURE = 0
+CHAT_MAX_TOKENS = 8192
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_DIM = 1536
+
+
+def is_offline(backend: str = BACKEND) -> bool:
+    return backend in ("replay", "stub")
+
+
+def uses_cassette(backend: str = BACKEND) -> bool:
+    """Record and replay must see every request, so the LLM and embedding caches are bypassed."""
+    return backend in ("record", "replay")
+
+
+def _hash(payload) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _messages_key(messages: List[BaseMessage], stop: Optional[List[str]]) -> str:
+    return _hash(
+        {
+            "model": CHAT_MODEL,
+            "temperature": CHAT_TEMPERATURE,
+            "messages": [(message.type, message.content) for message in messages],
+            "stop": stop,
+        }
+    )
+
+
+class Cassette:
+    """Append-only JSONL file of recorded responses keyed by request hash."""
+
+    def __init__(self, path: str = CASSETTE_PATH) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries: Dict[str, dict] = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.entries[entry["key"]] = entry
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.entries.get(key)
+
+    def record(self, kind: str, key: str, response: Any, latency: float) -> None:
+        entry = {"kind": kind, "key": key, "response": response, "latency": latency}
+        with self._lock:
+            self.entries[key] = entry
+            parent_dir = os.path.dirname(self.path)
+            if parent_dir:
+                os.makedirs(parent_dir, exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+
+def _stream_text(text: str, latency: float, run_manager: Optional[CallbackManagerForLLMRun]) -> None:
+    """Sleeps for latency, handing the text to the callbacks in pieces along the way."""
+    if run_manager is None:
+        time.sleep(latency)
+        return
+    pieces = [text[i : i + 20] for i in range(0, len(text), 20)] or [""]
+    for piece in pieces:
+        time.sleep(latency / len(pieces))
+        run_manager.on_llm_new_token(piece)
+
+
+class RecordingChatModel(BaseChatModel):
+    """Calls the wrapped chat model and saves each response to the cassette."""
+
+    inner: BaseChatModel
+    cassette: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "recording"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        start = time.monotonic()
+        result = self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        self.cassette.record(
+            "chat",
+            _messages_key(messages, stop),
+            result.generations[0].message.content,
+            time.monotonic() - start,
+        )
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return self._generate(messages, stop=stop, **kwargs)
+
+
+class ReplayChatModel(BaseChatModel):
+    """Serves chat responses from the cassette, optionally with their recorded latency."""
+
+    cassette: Any
+    latency_scale: float = REPLAY_LATENCY_SCALE
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        entry = self.cassette.get(_messages_key(messages, stop))
+        if entry is None:
+            raise KeyError("No recorded response for this prompt, record it with DOCIFY_BACKEND=record")
+        _stream_text(entry["response"], entry["latency"] * self.latency_scale, run_manager)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=entry["response"]))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return self._generate(messages, stop=stop, **kwargs)
+
+
+class StubChatModel(BaseChatModel):
+    """Answers every prompt with a canned response after a fixed delay, for load testing."""
+
+    latency: float = STUB_LATENCY
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        prompt = messages[-1].content if messages else ""
+        text = f"<answer>\nStub response for a {len(prompt)} character prompt.\n</answer>"
+        _stream_text(text, self.latency, run_manager)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return self._generate(messages, stop=stop, **kwargs)
+
+
+class RecordingEmbeddings(Embeddings):
+    def __init__(self, inner: Embeddings, cassette: Cassette) -> None:
+        self.inner = inner
+        self.cassette = cassette
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        start = time.monotonic()
+        vectors = self.inner.embed_documents(texts)
+        latency = (time.monotonic() - start) / max(len(texts), 1)
+        for text, vector in zip(texts, vectors):
+            self.cassette.record("embedding", _hash([EMBEDDING_MODEL, text]), vector, latency)
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class RateLimitedEmbeddings(Embeddings):
+    """Sends each request through the shared OpenAI request and token budget."""
+
+    def __init__(self, inner: Embeddings, provider: str = "openai") -> None:
+        self.inner = inner
+        self.limiter = rate_limits.limiter(provider)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        tokens = sum(count_tokens(text) for text in texts)
+        return self.limiter.call(lambda: self.inner.embed_documents(texts), tokens=tokens)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.limiter.call(lambda: self.inner.embed_query(text), tokens=count_tokens(text))
+
+
+class ReplayEmbeddings(Embeddings):
+    def __init__(self, cassette: Cassette, latency_scale: float = REPLAY_LATENCY_SCALE) -> None:
+        self.cassette = cassette
+        self.latency_scale = latency_scale
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        latency = 0.0
+        for text in texts:
+            entry = self.cassette.get(_hash([EMBEDDING_MODEL, text]))
+            if entry is None:
+                raise KeyError("No recorded embedding for this text, record it with DOCIFY_BACKEND=record")
+            vectors.append(entry["response"])
+            latency += entry["latency"]
+        time.sleep(latency * self.latency_scale)
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class StubEmbeddings(Embeddings):
+    """Deterministic pseudo-random unit vectors derived from the text hash."""
+
+    def __init__(self, dim: int = EMBEDDING_DIM) -> None:
+        self.dim = dim
+
+    def _embed(self, text: str) -> List[float]:
+        values = []
+        counter = 0
+        while len(values) < self.dim:
+            digest = hashlib.sha256(f"{counter}\0{text}".encode("utf-8")).digest()
+            values.extend((byte - 127.5) / 127.5 for byte in digest)
+            counter += 1
+        values = values[: self.dim]
+        norm = sum(v * v for v in values) ** 0.5
+        return [v / norm for v in values]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+_cassette: Optional[Cassette] = None
+
+
+def get_cassette() -> Cassette:
+    global _cassette
+    if _cassette is None:
+        _cassette = Cassette()
+    return _cassette
+
+
+def get_chat_model(streaming: bool = False, backend: str = BACKEND) -> BaseChatModel:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+    if backend == "replay":
+        return ReplayChatModel(cassette=get_cassette())
+    if backend == "stub":
+        return StubChatModel()
+    chat = ChatAnthropic(
+        model=CHAT_MODEL,
+        temperature=CHAT_TEMPERATURE,
+        max_tokens_to_sample=CHAT_MAX_TOKENS,
+        streaming=streaming,
+    )
+    # 429s, 5xx and connection errors are retried by the shared limiter in run_chain, the SDK
+    # would retry them again unseen
+    chat.client = chat.client.with_options(max_retries=0)
+    chat.async_client = chat.async_client.with_options(max_retries=0)
+    if backend == "record":
+        return RecordingChatModel(inner=chat, cassette=get_cassette())
+    return chat
+
+
+def get_embeddings(backend: str = BACKEND) -> Embeddings:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+    if backend == "replay":
+        return ReplayEmbeddings(get_cassette())
+    if backend == "stub":
+        return StubEmbeddings()
+    # LangChain passes max_retries to tenacity's stop_after_attempt, so 1 is a single attempt.
+    # RateLimitedEmbeddings retries 429s, 5xx and connection errors through the shared limiter instead.
+    embeddings = RateLimitedEmbeddings(OpenAIEmbeddings(model=EMBEDDING_MODEL, max_retries=1))
+    if backend == "record":
+        return RecordingEmbeddings(embeddings, get_cassette())
+    return embeddings
@@ -0,0 +1,135 @@
+import ast
+import csv
+import os
+import re
+import sqlite3
+import sys
+import threading
+from typing import Iterator, List, Optional
+
+from custom_types import Source, SourceType, Metadata
+
+DEFAULT_CORPUS_PATH = "src/data/corpus.sqlite"
+LEGACY_CSV_PATH = "src/data/data.csv"
+
+
+class CorpusStore:
+    """Crawled pages keyed by url.
+
+    Rows are written one at a time as they are crawled and content is only read
+    for the urls that are asked for, so nothing needs the whole corpus in memory.
+    """
+
+    def __init__(self, path: str = DEFAULT_CORPUS_PATH) -> None:
+        parent_dir = os.path.dirname(path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sources (
+                url TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                source_type TEXT NOT NULL,
+                fetched_at REAL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def append(self, source: Source) -> None:
+        """Inserts or replaces the row for source.url."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sources (url, content, source_type, fetched_at) VALUES (?, ?, ?, ?)",
+                (
+                    source.url,
+                    source.content,
+                    SourceType(source.metadata.source_type).value,
+                    source.metadata.fetched_at,
+                ),
+            )
+            self._conn.commit()
+
+    def get(self, url: str) -> Optional[Source]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT url, content, source_type, fetched_at FROM sources WHERE url = ?",
+                (url,),
+            ).fetchone()
+        return self._to_source(row) if row else None
+
+    def get_content(self, url: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content FROM sources WHERE url = ?", (url,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def urls(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT url FROM sources ORDER BY url")]
+
+    def iter_sources(self) -> Iterator[Source]:
+        """Yields every source, reading one row at a time."""
+        for url in self.urls():
+            source = self.get(url)
+            if source is not None:
+                yield source
+
+    def __contains__(self, url: str) -> bool:
+        with self._lock:
+            return (
+                self._conn.execute("SELECT 1 FROM sources WHERE url = ?", (url,)).fetchone()
+                is not None
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+
+    def import_csv(self, path: str = LEGACY_CSV_PATH) -> int:
+        """Loads a data.csv written by the old crawl script. Returns the number of rows imported."""
+        csv.field_size_limit(sys.maxsize)
+        count = 0
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                self.append(
+                    Source(
+                        url=row["url"],
+                        content=row["content"],
+                        metadata=Metadata(source_type=_parse_legacy_source_type(row["metadata"])),
+                    )
+                )
+                count += 1
+        return count
+
+    @staticmethod
+    def _to_source(row) -> Source:
+        url, content, source_type, fetched_at = row
+        return Source(
+            url=url,
+            content=content,
+            metadata=Metadata(source_type=SourceType(source_type), fetched_at=fetched_at),
+        )
+
+
+def _parse_legacy_source_type(metadata: str) -> SourceType:
+    # pandas wrote the dataclass as e.g. "{'source_type': <SourceType.Official: 'Official'>}"
+    match = re.search(r"SourceType\.(\w+)", metadata)
+    if match:
+        return SourceType[match.group(1)]
+    try:
+        return SourceType(ast.literal_eval(metadata)["source_type"])
+    except (ValueError, SyntaxError, KeyError, TypeError):
+        return SourceType.Official
+
+
+def open_corpus(path: str = DEFAULT_CORPUS_PATH, legacy_csv_path: str = LEGACY_CSV_PATH) -> CorpusStore:
+    """Opens the corpus store, importing the legacy CSV the first time if there is one."""
+    store = CorpusStore(path)
+    if len(store) == 0 and os.path.isfile(legacy_csv_path):
+        store.import_csv(legacy_csv_path)
+    return store
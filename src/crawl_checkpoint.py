@@ -0,0 +1,47 @@
+import json
+import os
+import time
+from typing import Dict, Optional, Set
+
+DEFAULT_CHECKPOINT_PATH = "src/data/crawl_checkpoint.jsonl"
+
+
+class CrawlCheckpoint:
+    """Append-only log of the urls a crawl has finished or failed.
+
+    Every line is flushed as it is written, so a crash loses at most the page in flight.
+    """
+
+    def __init__(self, path: str = DEFAULT_CHECKPOINT_PATH, resume: bool = False) -> None:
+        parent_dir = os.path.dirname(path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        self.path = path
+        # url -> error, None for urls that finished
+        self.status: Dict[str, Optional[str]] = {}
+        if resume and os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Partially written last line from a crash
+                        continue
+                    self.status[entry["url"]] = entry.get("error")
+        self._file = open(path, "a" if resume else "w")
+
+    @property
+    def done(self) -> Set[str]:
+        return {url for url, error in self.status.items() if error is None}
+
+    @property
+    def failed(self) -> Set[str]:
+        return {url for url, error in self.status.items() if error is not None}
+
+    def record(self, url: str, error: Optional[str] = None) -> None:
+        self.status[url] = error
+        self._file.write(json.dumps({"url": url, "error": error, "at": time.time()}) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
@@ -4,10 +4,12 @@ from typing import Optional, cast
 import urllib.parse as urlparse
 from abc import ABC, abstractmethod
 import logging
+import time
 import requests
-from bs4 import BeautifulSoup, Tag
+from bs4 import BeautifulSoup, SoupStrainer, Tag
 from markdownify import MarkdownConverter
 from custom_types import Source, SourceType, Metadata
+from http_cache import HttpCache
 from langchain.document_loaders import UnstructuredURLLoader
 from unstructured.cleaners.core import  clean, clean_extra_whitespace
 from youtube_transcript_api import YouTubeTranscriptApi
@@ -18,6 +20,10 @@ from env_var import GOOGLE_API_KEY
 
 logger = logging.getLogger(__name__)
 
+# "html.parser" parses the whole page with the pure python parser. "lxml" uses the C parser
+# and only builds the tree for the <article> subtree, which is where our content lives.
+EXTRACTION_BACKENDS = ("html.parser", "lxml")
+
 
 class Crawler(ABC):
     @abstractmethod
@@ -27,10 +33,16 @@ class Crawler(ABC):
 
 
 class WebpageCrawler(Crawler):
-    def __init__(self, source_type: SourceType, use_unstructured=True) -> None:
+    def __init__(self, source_type: SourceType, use_unstructured=True, http_cache: Optional[HttpCache] = None, extraction_backend: str = "html.parser") -> None:
         super().__init__()
+        if extraction_backend not in EXTRACTION_BACKENDS:
+            raise ValueError(f"Unknown extraction backend {extraction_backend}, expected one of {EXTRACTION_BACKENDS}")
         self.source_type = source_type
         self.use_unstructured = use_unstructured
+        self.http_cache = http_cache
+        self.extraction_backend = extraction_backend
+        # Urls the server reported as not modified since the last crawl
+        self.unchanged = []
 
     def _get_webpage_body(self, url: str) -> Tag:
         """Uses BeautifulSoup4 to fetch a webpage's HTML body given a URL"""
@@ -39,8 +51,14 @@ class WebpageCrawler(Crawler):
             raise Exception(
                 f"Failed to fetch the webpage. Status code: {response.status_code}"
             )
-        html_content = response.text
-        soup = BeautifulSoup(html_content, "html.parser")
+        return self._extract_body(response.text, url)
+
+    def _extract_body(self, html_content: str, url: str) -> Tag:
+        """Finds the main markdown content of an already fetched page"""
+        if self.extraction_backend == "lxml":
+            soup = BeautifulSoup(html_content, "lxml", parse_only=SoupStrainer("article"))
+        else:
+            soup = BeautifulSoup(html_content, "html.parser")
         parent = soup.find("article")
         if not parent:
             raise Exception(f"No article tag found for url {url}")
@@ -50,6 +68,25 @@ class WebpageCrawler(Crawler):
     def _html_to_markdown(self, body: Tag) -> str:
         return MarkdownConverter().convert_soup(body)
 
+    def _get_markdown(self, url: str) -> str:
+        """Fetches and converts a page, reusing the cached markdown when the page is unchanged"""
+        if self.http_cache is None:
+            return self._html_to_markdown(self._get_webpage_body(url))
+
+        status_code, html_content, unchanged = self.http_cache.get(url)
+        if status_code != 200:
+            raise Exception(
+                f"Failed to fetch the webpage. Status code: {status_code}"
+            )
+        if unchanged:
+            self.unchanged.append(url)
+            cached = self.http_cache.lookup(url)
+            if cached is not None and cached.derived is not None:
+                return cached.derived
+        content = self._html_to_markdown(self._extract_body(html_content, url))
+        self.http_cache.store_derived(url, content)
+        return content
+
     def generate_row(self, url: str) -> Source:
         logging.info("Starting webpage crawling")
         if self.use_unstructured:
@@ -58,14 +95,16 @@ class WebpageCrawler(Crawler):
                 content=self._get_unstructured_document(url),
                 metadata=Metadata(
                     source_type=self.source_type,
+                    fetched_at=time.time(),
                 ),
             )
         else:
             res = Source(
                 url=url,
-                content=self._html_to_markdown(self._get_webpage_body(url)),
+                content=self._get_markdown(url),
                 metadata=Metadata(
                     source_type=self.source_type,
+                    fetched_at=time.time(),
                 ),
             )
         logger.info("Finished webpage crawling")
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import List, cast
+from typing import List, Optional, cast
 from dataclasses import dataclass
 
 
@@ -13,6 +13,8 @@ class SourceType(str, Enum):
 @dataclass
 class Metadata:
     source_type: SourceType
+    # Unix timestamp of when the page was crawled
+    fetched_at: Optional[float] = None
 
 
 @dataclass
@@ -0,0 +1,90 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import List, Tuple
+
+import tiktoken
+from langchain.embeddings.base import Embeddings
+from llama_index.schema import MetadataMode
+
+logger = logging.getLogger(__name__)
+
+# OpenAI accepts up to 2048 inputs per request, stay well under that and the token cap
+MAX_BATCH_SIZE = 256
+MAX_BATCH_TOKENS = 100_000
+MAX_CONCURRENT_BATCHES = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = "cl100k_base"):
+    return tiktoken.get_encoding(name)
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text))
+
+
+@dataclass
+class EmbeddingStats:
+    texts: int = 0
+    tokens: int = 0
+    elapsed: float = 0.0
+    # (number of texts, tokens, seconds) per batch
+    batches: List[Tuple[int, int, float]] = field(default_factory=list)
+
+
+def make_batches(texts: List[str], max_batch_size: int = MAX_BATCH_SIZE, max_batch_tokens: int = MAX_BATCH_TOKENS) -> List[List[int]]:
+    """Groups text indices into batches bounded by both count and token total."""
+    batches = []
+    current, current_tokens = [], 0
+    for i, text in enumerate(texts):
+        tokens = count_tokens(text)
+        if current and (len(current) >= max_batch_size or current_tokens + tokens > max_batch_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def embed_texts(embeddings: Embeddings, texts: List[str], max_concurrent_batches: int = MAX_CONCURRENT_BATCHES) -> Tuple[List[List[float]], EmbeddingStats]:
+    """Embeds texts in provider sized batches, a few batches at a time."""
+    stats = EmbeddingStats(texts=len(texts))
+    vectors: List[List[float]] = [None] * len(texts)
+    batches = make_batches(texts)
+
+    def embed_batch(indices):
+        batch = [texts[i] for i in indices]
+        tokens = sum(count_tokens(text) for text in batch)
+        start = time.perf_counter()
+        batch_vectors = embeddings.embed_documents(batch)
+        return indices, batch_vectors, tokens, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_concurrent_batches) as executor:
+        for batch_number, (indices, batch_vectors, tokens, elapsed) in enumerate(
+            executor.map(embed_batch, batches)
+        ):
+            for i, vector in zip(indices, batch_vectors):
+                vectors[i] = vector
+            stats.tokens += tokens
+            stats.batches.append((len(indices), tokens, elapsed))
+            logger.info(
+                f"Embedded batch {batch_number + 1}/{len(batches)}: {len(indices)} texts, {tokens} tokens in {elapsed:.2f}s"
+            )
+    stats.elapsed = time.perf_counter() - start
+    logger.info(f"Embedded {stats.texts} texts ({stats.tokens} tokens) in {stats.elapsed:.2f}s")
+    return vectors, stats
+
+
+def embed_nodes(embeddings: Embeddings, nodes) -> EmbeddingStats:
+    """Sets node.embedding on every node that doesn't have one yet."""
+    pending = [node for node in nodes if node.embedding is None]
+    vectors, stats = embed_texts(embeddings, [node.get_content(metadata_mode=MetadataMode.EMBED) for node in pending])
+    for node, vector in zip(pending, vectors):
+        node.embedding = vector
+    return stats
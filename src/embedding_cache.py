@@ -0,0 +1,207 @@
+import argparse
+import fcntl
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBEDDING_CACHE_DIR = "src/data/embedding_cache"
+
+
+def make_key(model_name: str, text: str) -> str:
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Embeddings keyed by (model, chunk text) hash.
+
+    Vectors live in an append-only float32 file that is memory-mapped for reads,
+    so lookups return views into the file instead of copies. A SQLite index maps
+    each key to its row. Several processes may share the cache: appends and
+    compaction hold an exclusive lock on a lock file next to the vectors, lookups
+    a shared one.
+    """
+
+    def __init__(self, directory: str = DEFAULT_EMBEDDING_CACHE_DIR) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.lock_path = os.path.join(directory, "vectors.lock")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(directory, "index.sqlite"), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, row INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+        row = self._conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        self.dim: Optional[int] = int(row[0]) if row else None
+        self._vectors: Optional[np.memmap] = None
+        # Inode of the mapped file, compaction in another process replaces it
+        self._mapped_inode: Optional[int] = None
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool) -> Iterator[None]:
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _num_rows(self) -> int:
+        if self.dim is None or not os.path.isfile(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (self.dim * 4)
+
+    def _mapped(self, min_rows: int) -> np.memmap:
+        """Returns the memory map, remapping if rows were appended since it was opened."""
+        if self.dim is None:
+            # Set by another process after this one opened the cache
+            self.dim = int(self._conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()[0])
+        inode = os.stat(self.vectors_path).st_ino
+        if self._vectors is None or len(self._vectors) < min_rows or inode != self._mapped_inode:
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r").reshape(-1, self.dim)
+            self._mapped_inode = inode
+        return self._vectors
+
+    def get_many(self, model_name: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        keys = [make_key(model_name, text) for text in texts]
+        with self._lock, self._file_lock(exclusive=False):
+            rows = {}
+            vectors = None
+            for key in set(keys):
+                found = self._conn.execute("SELECT row FROM entries WHERE key = ?", (key,)).fetchone()
+                if found:
+                    rows[key] = found[0]
+            if rows:
+                self._conn.executemany(
+                    "UPDATE entries SET last_used = ? WHERE key = ?",
+                    [(time.time(), key) for key in rows],
+                )
+                self._conn.commit()
+                vectors = self._mapped(max(rows.values()) + 1)
+            results = [vectors[rows[key]] if key in rows else None for key in keys]
+            hits = sum(result is not None for result in results)
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def put_many(self, model_name: str, texts: List[str], vectors: List[List[float]]) -> None:
+        if not texts:
+            return
+        array = np.asarray(vectors, dtype=np.float32)
+        # Held from reading the file size until the rows are indexed, so concurrent
+        # writers never hand out the same row numbers
+        with self._lock, self._file_lock(exclusive=True):
+            if self.dim is None:
+                self._conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('dim', ?)", (str(array.shape[1]),))
+                # Another process may have set it first
+                self.dim = int(self._conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()[0])
+            if array.shape[1] != self.dim:
+                raise ValueError(f"Expected embeddings of dimension {self.dim}, got {array.shape[1]}")
+            first_row = self._num_rows()
+            with open(self.vectors_path, "ab") as f:
+                f.write(array.tobytes())
+            now = time.time()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, row, last_used) VALUES (?, ?, ?)",
+                [(make_key(model_name, text), first_row + i, now) for i, text in enumerate(texts)],
+            )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            rows = self._num_rows()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "orphaned_rows": rows - entries,
+        }
+
+    def compact(self, max_age_days: Optional[float] = None) -> dict:
+        """Drops entries unused for max_age_days and rewrites the vectors file without dead rows."""
+        with self._lock, self._file_lock(exclusive=True):
+            if max_age_days is not None:
+                cutoff = time.time() - max_age_days * 24 * 60 * 60
+                self._conn.execute("DELETE FROM entries WHERE last_used < ?", (cutoff,))
+            entries = self._conn.execute("SELECT key, row FROM entries ORDER BY row").fetchall()
+            before = self._num_rows()
+            if self.dim is None or before == 0:
+                self._conn.commit()
+                return {"rows_before": before, "rows_after": 0}
+
+            vectors = self._mapped(before)
+            tmp_path = f"{self.vectors_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                for _, row in entries:
+                    f.write(vectors[row].tobytes())
+            self._vectors = None
+            os.replace(tmp_path, self.vectors_path)
+            self._conn.executemany(
+                "UPDATE entries SET row = ? WHERE key = ?",
+                [(new_row, key) for new_row, (key, _) in enumerate(entries)],
+            )
+            self._conn.commit()
+        logger.info(f"Compacted embedding cache from {before} to {len(entries)} rows")
+        return {"rows_before": before, "rows_after": len(entries)}
+
+
+class CachedEmbeddings(Embeddings):
+    """Serves embeddings from an EmbeddingCache and only sends misses to the wrapped model."""
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model_name: str) -> None:
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        cached = self.cache.get_many(self.model_name, texts)
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        # Identical chunks within one call are embedded once
+        missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+        if missing_texts:
+            new_vectors = self.embeddings.embed_documents(missing_texts)
+            self.cache.put_many(self.model_name, missing_texts, new_vectors)
+            by_text = dict(zip(missing_texts, new_vectors))
+        else:
+            by_text = {}
+        return [
+            list(by_text[texts[i]]) if vector is None else vector.tolist()
+            for i, vector in enumerate(cached)
+        ]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["stats", "compact"])
+    parser.add_argument("--directory", default=DEFAULT_EMBEDDING_CACHE_DIR)
+    parser.add_argument(
+        "--max-age-days",
+        type=float,
+        help="When compacting, also drop entries that haven't been used for this many days",
+    )
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.directory)
+    if args.command == "compact":
+        print(cache.compact(args.max_age_days))
+    print(cache.stats())
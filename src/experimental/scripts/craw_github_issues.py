@@ -4,6 +4,8 @@ import json
 
 import requests
 
+from rate_limit import rate_limits
+
 async def main():
     # Create the parser
     parser = argparse.ArgumentParser()
@@ -27,7 +29,7 @@ async def main():
     while True:
         print(f"Fetching page {page_number}")
         issues_url = f"https://api.github.com/repos/{repo}/issues?per_page=100&page={page_number}&state=all"
-        response = requests.get(issues_url, headers=headers)
+        response = rate_limits.limiter("github").call(lambda: requests.get(issues_url, headers=headers))
         if response.status_code != 200:
             print(f"Error fetching {issues_url=}: {response.text}")
             exit(1)
@@ -0,0 +1,127 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Iterator, Optional, Tuple
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HTTP_CACHE_PATH = "src/data/http_cache.sqlite"
+
+
+@dataclass
+class CachedResponse:
+    url: str
+    body: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    # Result of post-processing the body (e.g. the converted markdown), so 304s skip parsing too
+    derived: Optional[str]
+
+
+class HttpCache:
+    """On-disk store of response bodies and their validators for conditional GETs."""
+
+    def __init__(self, path: str = DEFAULT_HTTP_CACHE_PATH, limiter=None) -> None:
+        parent_dir = os.path.dirname(path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        self.path = path
+        self.unchanged = 0
+        self.fetched = 0
+        # Optional rate_limit.ProviderLimiter that every request goes through
+        self.limiter = limiter
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                body TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                derived TEXT,
+                fetched_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def lookup(self, url: str) -> Optional[CachedResponse]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body, etag, last_modified, derived FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None:
+            return None
+        return CachedResponse(url, *row)
+
+    def conditional_headers(self, url: str) -> dict:
+        cached = self.lookup(url)
+        headers = {}
+        if cached is None:
+            return headers
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+        return headers
+
+    def store(self, url: str, headers, body: str) -> None:
+        """Saves a fresh 200 response. Any derived value is dropped since the body changed."""
+        with self._lock:
+            self.fetched += 1
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (url, body, etag, last_modified, derived, fetched_at) VALUES (?, ?, ?, ?, NULL, ?)",
+                (url, body, headers.get("ETag"), headers.get("Last-Modified"), time.time()),
+            )
+            self._conn.commit()
+
+    def store_derived(self, url: str, derived: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE responses SET derived = ? WHERE url = ?", (derived, url)
+            )
+            self._conn.commit()
+
+    def mark_unchanged(self, url: str) -> Optional[CachedResponse]:
+        """Records a 304 for the url and returns the cached response it refers to."""
+        cached = self.lookup(url)
+        if cached is not None:
+            with self._lock:
+                self.unchanged += 1
+        return cached
+
+    def get(self, url: str, headers: Optional[dict] = None, session=None) -> Tuple[int, str, bool]:
+        """Conditional GET with requests. Returns (status code, body, unchanged)."""
+        http = session or requests
+
+        def fetch(request_headers):
+            if self.limiter is None:
+                return http.get(url, headers=request_headers)
+            return self.limiter.call(lambda: http.get(url, headers=request_headers))
+
+        response = fetch({**(headers or {}), **self.conditional_headers(url)})
+        if response.status_code == 304:
+            cached = self.mark_unchanged(url)
+            if cached is not None:
+                return 200, cached.body, True
+            # Lost our copy of the body, fetch it again unconditionally
+            response = fetch(headers)
+        if response.status_code == 200:
+            self.store(url, response.headers, response.text)
+        return response.status_code, response.text, False
+
+    def iter_bodies(self) -> Iterator[Tuple[str, str]]:
+        """Yields (url, body) for every cached response."""
+        with self._lock:
+            rows = self._conn.execute("SELECT url, body FROM responses").fetchall()
+        yield from rows
+
+    def stats(self) -> dict:
+        return {"fetched": self.fetched, "unchanged": self.unchanged}
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import uuid
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional
+
+from langchain.embeddings.base import Embeddings
+from llama_index.vector_stores import ChromaVectorStore, PineconeVectorStore
+from llama_index.vector_stores.types import NodeWithEmbedding
+
+from custom_types import Source
+from embedding import embed_nodes
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SYNC_STATE_DIR = "src/data/index_sync"
+BATCH_SIZE = 100
+
+
+@dataclass
+class SyncReport:
+    added: int = 0
+    updated: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+    nodes_upserted: int = 0
+    nodes_deleted: int = 0
+
+
+def hash_source(source: Source) -> str:
+    return hashlib.sha256(source.content.encode("utf-8")).hexdigest()
+
+
+def assign_node_ids(nodes: list) -> list:
+    """Replaces the parser's random node ids with ids derived from the document url and chunk index.
+
+    Rebuilding or re-syncing a page then overwrites its vectors instead of adding copies.
+    """
+    new_ids = {}
+    chunk_counts: Dict[str, int] = {}
+    for node in nodes:
+        index = chunk_counts.get(node.ref_doc_id, 0)
+        chunk_counts[node.ref_doc_id] = index + 1
+        new_ids[node.node_id] = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{node.ref_doc_id}#{index}"))
+    for node in nodes:
+        # Keep the previous/next links between chunks pointing at the new ids
+        for related in node.relationships.values():
+            for info in related if isinstance(related, list) else [related]:
+                info.node_id = new_ids.get(info.node_id, info.node_id)
+    for node in nodes:
+        node.id_ = new_ids[node.node_id]
+    return nodes
+
+
+class SyncState:
+    """Per-document content hash and the node ids stored for it in one vector store."""
+
+    def __init__(self, name: str, directory: str = DEFAULT_SYNC_STATE_DIR) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(directory, f"{name}.sqlite"))
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, content_hash TEXT NOT NULL, node_ids TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def all(self) -> Dict[str, str]:
+        return dict(self._conn.execute("SELECT doc_id, content_hash FROM documents"))
+
+    def node_ids(self, doc_id: str) -> List[str]:
+        row = self._conn.execute(
+            "SELECT node_ids FROM documents WHERE doc_id = ?", (doc_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def record(self, doc_id: str, content_hash: str, node_ids: List[str]) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO documents (doc_id, content_hash, node_ids) VALUES (?, ?, ?)",
+            (doc_id, content_hash, json.dumps(node_ids)),
+        )
+        self._conn.commit()
+
+    def record_index(self, sources: List[Source], nodes: list) -> None:
+        """Records a freshly built index, so the next sync only touches what changed since."""
+        node_ids: Dict[str, List[str]] = {}
+        for node in nodes:
+            node_ids.setdefault(node.ref_doc_id, []).append(node.node_id)
+        self._conn.execute("DELETE FROM documents")
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO documents (doc_id, content_hash, node_ids) VALUES (?, ?, ?)",
+            [(s.url, hash_source(s), json.dumps(node_ids.get(s.url, []))) for s in sources],
+        )
+        self._conn.commit()
+
+    def remove(self, doc_id: str) -> None:
+        self._conn.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,))
+        self._conn.commit()
+
+
+def delete_node_ids(vector_store, node_ids: List[str]) -> None:
+    """Deletes vectors by id in batches using the store's native client."""
+    for i in range(0, len(node_ids), BATCH_SIZE):
+        batch = node_ids[i : i + BATCH_SIZE]
+        if isinstance(vector_store, PineconeVectorStore):
+            # Delete by metadata filter isn't available on every Pinecone tier, ids always are
+            vector_store._pinecone_index.delete(ids=batch, namespace=vector_store._namespace)
+        elif isinstance(vector_store, ChromaVectorStore):
+            vector_store._collection.delete(ids=batch)
+        elif hasattr(vector_store, "delete_nodes"):
+            vector_store.delete_nodes(batch)
+        else:
+            raise ValueError(f"Don't know how to delete nodes from {type(vector_store).__name__}")
+
+
+def sync_index(
+    vector_store,
+    state: SyncState,
+    sources: Iterable[Source],
+    get_nodes: Callable[[List[Source]], list],
+    embeddings: Embeddings,
+    live_urls: Optional[Iterable[str]] = None,
+) -> SyncReport:
+    """Brings vector_store in line with sources, touching only documents whose content changed.
+
+    Documents that are no longer in sources are deleted. With live_urls, sources outside
+    it are treated as removed too, e.g. pages still in the corpus but gone from the site.
+    """
+    report = SyncReport()
+    live = set(live_urls) if live_urls is not None else None
+    if live is not None and not live:
+        # Most likely discovery failed, don't wipe the index over it
+        raise ValueError("No live urls given, refusing to delete every document")
+    previous = state.all()
+    seen = set()
+    pending: List[Source] = []
+
+    def flush():
+        nodes = get_nodes(pending)
+        embed_nodes(embeddings, nodes)
+        nodes_by_doc: Dict[str, list] = {}
+        for node in nodes:
+            nodes_by_doc.setdefault(node.ref_doc_id, []).append(node)
+        for source in pending:
+            doc_nodes = nodes_by_doc.get(source.url, [])
+            stale_ids = state.node_ids(source.url)
+            if stale_ids:
+                delete_node_ids(vector_store, stale_ids)
+                report.nodes_deleted += len(stale_ids)
+            for i in range(0, len(doc_nodes), BATCH_SIZE):
+                vector_store.add(
+                    [
+                        NodeWithEmbedding(node=node, embedding=node.embedding)
+                        for node in doc_nodes[i : i + BATCH_SIZE]
+                    ]
+                )
+            report.nodes_upserted += len(doc_nodes)
+            state.record(source.url, hash_source(source), [node.node_id for node in doc_nodes])
+        pending.clear()
+
+    for source in sources:
+        if live is not None and source.url not in live:
+            continue
+        seen.add(source.url)
+        content_hash = hash_source(source)
+        if previous.get(source.url) == content_hash:
+            report.unchanged += 1
+            continue
+        if source.url in previous:
+            report.updated += 1
+        else:
+            report.added += 1
+        pending.append(source)
+        if len(pending) >= BATCH_SIZE:
+            flush()
+    if pending:
+        flush()
+
+    for doc_id in set(previous) - seen:
+        node_ids = state.node_ids(doc_id)
+        delete_node_ids(vector_store, node_ids)
+        state.remove(doc_id)
+        report.deleted += 1
+        report.nodes_deleted += len(node_ids)
+
+    logger.info(f"Index sync: {report}")
+    return report
@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+from tabulate import tabulate
+
+# USD per million input and output tokens
+PRICES = {
+    "claude-2": (11.02, 32.68),
+    "text-embedding-ada-002": (0.10, 0.0),
+}
+
+
+@dataclass
+class Span:
+    stage: str
+    page: Optional[str] = None
+    model: Optional[str] = None
+    start: float = 0.0
+    wall_time: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    retries: int = 0
+    cached: bool = False
+    error: Optional[str] = None
+    extra: Dict[str, object] = field(default_factory=dict)
+
+    @property
+    def cost(self) -> float:
+        # Cached responses cost nothing
+        if self.cached or self.model not in PRICES:
+            return 0.0
+        input_price, output_price = PRICES[self.model]
+        return (self.input_tokens * input_price + self.output_tokens * output_price) / 1e6
+
+
+class Instrumentation:
+    """Span timers and counters for a run, attributed to the page being processed by each thread.
+
+    Spans are kept in memory for the summary and, once start() is called, appended to a JSONL file.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._file = None
+        self.spans: List[Span] = []
+        self.counters: Dict[str, float] = {}
+
+    def start(self, path: str) -> None:
+        parent_dir = os.path.dirname(path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        with self._lock:
+            self._file = open(path, "a")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    @contextmanager
+    def page(self, page_name: str) -> Iterator[None]:
+        """Attributes the spans recorded by this thread to page_name."""
+        previous = getattr(self._local, "page", None)
+        self._local.page = page_name
+        try:
+            yield
+        finally:
+            self._local.page = previous
+
+    @contextmanager
+    def span(self, stage: str, **extra) -> Iterator[Span]:
+        span = Span(stage=stage, page=getattr(self._local, "page", None), start=time.time(), extra=extra)
+        stack = self._span_stack()
+        stack.append(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.wall_time = time.perf_counter() - start
+            stack.pop()
+            self._record(span)
+
+    def _span_stack(self) -> List[Span]:
+        if not hasattr(self._local, "spans"):
+            self._local.spans = []
+        return self._local.spans
+
+    def current_span(self) -> Optional[Span]:
+        """Innermost span open in this thread, so nested code can add retries or tokens to it."""
+        stack = self._span_stack()
+        return stack[-1] if stack else None
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def _record(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+            if self._file is not None:
+                self._file.write(json.dumps({**asdict(span), "cost": span.cost}) + "\n")
+                self._file.flush()
+
+    def summary(self) -> List[dict]:
+        """Totals per stage."""
+        with self._lock:
+            spans = list(self.spans)
+        stages: Dict[str, List[Span]] = {}
+        for span in spans:
+            stages.setdefault(span.stage, []).append(span)
+
+        rows = []
+        for stage, stage_spans in stages.items():
+            times = sorted(span.wall_time for span in stage_spans)
+            rows.append({
+                "stage": stage,
+                "calls": len(stage_spans),
+                "total_s": sum(times),
+                "mean_s": sum(times) / len(times),
+                "p95_s": times[min(int(0.95 * len(times)), len(times) - 1)],
+                "input_tokens": sum(span.input_tokens for span in stage_spans),
+                "output_tokens": sum(span.output_tokens for span in stage_spans),
+                "retries": sum(span.retries for span in stage_spans),
+                "errors": sum(span.error is not None for span in stage_spans),
+                "cost_usd": sum(span.cost for span in stage_spans),
+            })
+        return sorted(rows, key=lambda row: row["total_s"], reverse=True)
+
+    def summary_table(self) -> str:
+        return tabulate(self.summary(), headers="keys", floatfmt=".3f")
+
+    def write_prometheus(self, path: str) -> None:
+        """Writes the totals in the Prometheus text format, for the node exporter textfile collector."""
+        lines = []
+        metrics = [
+            ("docify_stage_calls_total", "calls", "Spans recorded per stage"),
+            ("docify_stage_seconds_total", "total_s", "Wall time spent per stage"),
+            ("docify_stage_input_tokens_total", "input_tokens", "Prompt tokens per stage"),
+            ("docify_stage_output_tokens_total", "output_tokens", "Completion tokens per stage"),
+            ("docify_stage_retries_total", "retries", "Retries per stage"),
+            ("docify_stage_errors_total", "errors", "Failed spans per stage"),
+            ("docify_stage_cost_usd_total", "cost_usd", "Estimated cost per stage"),
+        ]
+        rows = self.summary()
+        for name, key, help_text in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f'{name}{{stage="{row["stage"]}"}} {row[key]}' for row in rows)
+        with self._lock:
+            counters = dict(self.counters)
+        for counter, value in sorted(counters.items()):
+            name = f"docify_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+
+        parent_dir = os.path.dirname(path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        # Written atomically so the collector never reads a partial file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+
+metrics = Instrumentation()
@@ -0,0 +1,249 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional
+
+DEFAULT_QUEUE_PATH = "src/data/job_queue.sqlite"
+# A worker that stops heartbeating for this long loses its jobs to other workers
+LEASE_SECONDS = 600
+MAX_ATTEMPTS = 3
+
+
+@dataclass(frozen=True)
+class Lease:
+    url: str
+    worker_id: str
+    # Incremented every time the job is handed out. Only the holder of the latest
+    # fence may heartbeat, complete or fail the job.
+    fence: int
+
+
+class JobQueue:
+    """Durable queue of page jobs in SQLite, shared by the worker processes of one machine.
+
+    Jobs move pending -> leased -> done (or back to pending when a lease expires or
+    the job fails, until max_attempts is reached and it is marked failed).
+
+    SQLite's WAL mode and file locks aren't reliable on network filesystems, so the
+    queue must live on a local disk. It records the host that created it and refuses
+    to open anywhere else.
+    """
+
+    def __init__(self, path: str = DEFAULT_QUEUE_PATH, lease_seconds: float = LEASE_SECONDS, max_attempts: int = MAX_ATTEMPTS) -> None:
+        parent_dir = os.path.dirname(path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # Transactions are managed explicitly so leases can take the write lock up front
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                url TEXT PRIMARY KEY,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker_id TEXT,
+                lease_expires REAL,
+                fence INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                -- Hash of the page's inputs when the job was seeded
+                version TEXT,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "version" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN version TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('host', ?)", (socket.gethostname(),))
+        (host,) = self._conn.execute("SELECT value FROM meta WHERE key = 'host'").fetchone()
+        if host != socket.gethostname():
+            self._conn.close()
+            raise RuntimeError(
+                f"Job queue {path} was created on {host}. Workers on other machines can't share it safely, "
+                f"run them on {host} or give this machine its own queue"
+            )
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def seed(self, urls: List[str], reset: bool = False, versions: Optional[Dict[str, str]] = None) -> int:
+        """Adds a pending job per url. Returns the jobs added or reopened.
+
+        Existing jobs are kept unless reset is set, but a done or failed job whose version
+        in versions changed since it was seeded goes back to pending with fresh attempts.
+        """
+        now = time.time()
+        versions = versions or {}
+        with self._transaction() as conn:
+            if reset:
+                conn.execute("DELETE FROM jobs")
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT INTO jobs (url, version, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (url) DO UPDATE SET "
+                "status = 'pending', attempts = 0, version = excluded.version, updated_at = excluded.updated_at "
+                # A leased job keeps its old version, so the next seed reopens it once it is done
+                "WHERE status != 'leased' AND excluded.version IS NOT NULL AND version IS NOT excluded.version",
+                [(url, versions.get(url), now) for url in urls],
+            )
+            return conn.total_changes - before
+
+    def _requeue_expired(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "error = 'lease expired', worker_id = NULL, lease_expires = NULL, updated_at = ? "
+            "WHERE status = 'leased' AND lease_expires < ?",
+            (self.max_attempts, now, now),
+        )
+
+    def lease(self, worker_id: str, n: int = 1) -> List[Lease]:
+        """Hands out up to n pending jobs to worker_id, first re-queueing any expired leases."""
+        now = time.time()
+        with self._transaction() as conn:
+            self._requeue_expired(conn, now)
+            rows = conn.execute(
+                "SELECT url, fence FROM jobs WHERE status = 'pending' ORDER BY attempts, url LIMIT ?", (n,)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = 'leased', worker_id = ?, lease_expires = ?, fence = fence + 1, "
+                "attempts = attempts + 1, updated_at = ? WHERE url = ?",
+                [(worker_id, now + self.lease_seconds, now, url) for url, _ in rows],
+            )
+        return [Lease(url=url, worker_id=worker_id, fence=fence + 1) for url, fence in rows]
+
+    def heartbeat(self, lease: Lease) -> bool:
+        """Extends the lease. False means it expired and the job may belong to another worker now."""
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ? "
+                "WHERE url = ? AND fence = ? AND status = 'leased' AND lease_expires >= ?",
+                (now + self.lease_seconds, now, lease.url, lease.fence, now),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, lease: Lease, result: Optional[dict] = None, write: Optional[Callable[[], None]] = None) -> bool:
+        """Runs write, then marks the job done if the lease is still current.
+
+        write runs outside the queue's lock so other workers and heartbeats aren't held up by
+        it. The lease is renewed first, so write only overlaps with another worker's if it
+        takes longer than lease_seconds. Returns False when the lease was lost, without
+        writing if it was lost before write started.
+        """
+        if not self.heartbeat(lease):
+            return False
+        if write is not None:
+            write()
+        now = time.time()
+        with self._transaction() as conn:
+            # The fence alone decides: an expired lease that nobody took over still completes
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE url = ? AND fence = ? AND status = 'leased'",
+                (json.dumps(result or {}), now, lease.url, lease.fence),
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, lease: Lease, error: str) -> bool:
+        """Returns the job to the queue, or marks it failed after max_attempts."""
+        now = time.time()
+        with self._transaction() as conn:
+            if not self._is_current(conn, lease, now):
+                return False
+            conn.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "error = ?, worker_id = NULL, lease_expires = NULL, updated_at = ? WHERE url = ?",
+                (self.max_attempts, error, now, lease.url),
+            )
+            return True
+
+    @staticmethod
+    def _is_current(conn: sqlite3.Connection, lease: Lease, now: float) -> bool:
+        row = conn.execute(
+            "SELECT 1 FROM jobs WHERE url = ? AND fence = ? AND status = 'leased' AND lease_expires >= ?",
+            (lease.url, lease.fence, now),
+        ).fetchone()
+        return row is not None
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def failed(self) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute("SELECT url, error FROM jobs WHERE status = 'failed' ORDER BY url").fetchall()
+
+
+class LeaseKeeper:
+    """Heartbeats a worker's leases from a background thread while its jobs run."""
+
+    def __init__(self, queue: JobQueue, interval: Optional[float] = None) -> None:
+        self.queue = queue
+        self.interval = interval if interval is not None else queue.lease_seconds / 3
+        self._lock = threading.Lock()
+        self._leases: Dict[str, Lease] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "LeaseKeeper":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def add(self, lease: Lease) -> None:
+        with self._lock:
+            self._leases[lease.url] = lease
+
+    def remove(self, lease: Lease) -> None:
+        with self._lock:
+            # A newer lease on the same url stays
+            if self._leases.get(lease.url) == lease:
+                del self._leases[lease.url]
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                leases = list(self._leases.values())
+            for lease in leases:
+                if not self.queue.heartbeat(lease):
+                    # JobQueue.complete checks the fence again, so the result is dropped there
+                    self.remove(lease)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect the page job queue")
+    parser.add_argument("--path", default=DEFAULT_QUEUE_PATH)
+    parser.add_argument("--failed", action="store_true", help="List failed jobs and their errors")
+    args = parser.parse_args()
+
+    job_queue = JobQueue(args.path)
+    print(job_queue.counts())
+    if args.failed:
+        for url, error in job_queue.failed():
+            print(f"{url}: {error}")
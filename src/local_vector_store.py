@@ -0,0 +1,346 @@
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Optional, Tuple
+
+import numpy as np
+from llama_index.schema import TextNode
+from llama_index.vector_stores.types import (
+    NodeWithEmbedding,
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCAL_INDEX_DIR = "src/data/local_index"
+DTYPES = {"float16": np.float16, "int8": np.int8}
+# Rows scored per step of a flat scan, bounds the memory of a query regardless of corpus size
+BLOCK_ROWS = 65536
+
+
+class MmapVectorStore(VectorStore):
+    """Vector store kept on local disk, usable wherever Pinecone or Chroma are.
+
+    Embeddings are normalised and stored quantized (float16, or int8 with a
+    per-row scale) in an append-only file that is memory-mapped for queries, so
+    nothing is loaded into RAM up front. Nodes and their ids live in SQLite.
+    Queries are exact top-k by dot product unless an IVF index has been built
+    with build_ivf, in which case only the closest n_probe lists are scanned.
+    Writers in several processes take an exclusive lock on vectors.lock, queries a
+    shared one. Deleted rows stay in the files until compact (or build_ivf) runs.
+    """
+
+    stores_text: bool = True
+    is_embedding_query: bool = True
+
+    def __init__(self, directory: str = DEFAULT_LOCAL_INDEX_DIR, dtype: str = "float16", n_probe: int = 8) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.n_probe = n_probe
+        self._lock = threading.RLock()
+        self._meta_path = os.path.join(directory, "meta.json")
+        self._vectors_path = os.path.join(directory, "vectors.bin")
+        self._scales_path = os.path.join(directory, "scales.f32")
+        self._centroids_path = os.path.join(directory, "ivf_centroids.npy")
+        self._lists_path = os.path.join(directory, "ivf_lists.i32")
+        self._lock_path = os.path.join(directory, "vectors.lock")
+
+        if os.path.isfile(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+            self.dim: Optional[int] = meta["dim"]
+            self.dtype = meta["dtype"]
+        else:
+            if dtype not in DTYPES:
+                raise ValueError(f"Unknown dtype {dtype}, expected one of {list(DTYPES)}")
+            self.dim = None
+            self.dtype = dtype
+
+        self._conn = sqlite3.connect(os.path.join(directory, "nodes.sqlite"), check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS nodes (
+                row INTEGER PRIMARY KEY,
+                node_id TEXT NOT NULL,
+                ref_doc_id TEXT,
+                node TEXT NOT NULL,
+                deleted INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS nodes_node_id ON nodes (node_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS nodes_ref_doc_id ON nodes (ref_doc_id)")
+        self._conn.commit()
+        self._centroids = np.load(self._centroids_path) if os.path.isfile(self._centroids_path) else None
+        # Mask of rows that aren't deleted, reset whenever nodes are added or deleted
+        self._live_rows: Optional[np.ndarray] = None
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool = True) -> Iterator[None]:
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self) -> None:
+        """Picks up the dimension and IVF centroids another process may have written."""
+        if self.dim is None and os.path.isfile(self._meta_path):
+            with open(self._meta_path) as f:
+                self.dim = json.load(f)["dim"]
+        if self._centroids is None and os.path.isfile(self._centroids_path):
+            self._centroids = np.load(self._centroids_path)
+
+    def _num_rows(self) -> int:
+        if self.dim is None or not os.path.isfile(self._vectors_path):
+            return 0
+        return os.path.getsize(self._vectors_path) // (self.dim * np.dtype(DTYPES[self.dtype]).itemsize)
+
+    def _quantize(self, embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        normalized = embeddings / np.maximum(norms, 1e-12)
+        if self.dtype == "float16":
+            return normalized.astype(np.float16), np.ones(len(normalized), dtype=np.float32)
+        scales = np.maximum(np.abs(normalized).max(axis=1), 1e-12) / 127
+        quantized = np.round(normalized / scales[:, None]).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+
+    def _load_rows(self, rows) -> np.ndarray:
+        """Dequantized float32 copies of the given rows (a slice or index array) read through the memory map."""
+        vectors = np.memmap(self._vectors_path, dtype=DTYPES[self.dtype], mode="r").reshape(-1, self.dim)
+        block = np.asarray(vectors[rows], dtype=np.float32)
+        if self.dtype == "int8":
+            scales = np.memmap(self._scales_path, dtype=np.float32, mode="r")
+            block *= scales[rows][:, None]
+        return block
+
+    def add(self, embedding_results: List[NodeWithEmbedding]) -> List[str]:
+        if not embedding_results:
+            return []
+        embeddings = np.asarray([result.embedding for result in embedding_results], dtype=np.float32)
+        if embeddings.ndim != 2:
+            raise ValueError("Embeddings in one add call must all have the same dimension")
+        # Held from reading the file size until the rows are indexed, so concurrent
+        # writers never hand out the same row numbers
+        with self._file_lock(), self._lock:
+            self._refresh()
+            if self.dim is not None and embeddings.shape[1] != self.dim:
+                # Appending them would misalign every row after them in the vectors file
+                raise ValueError(
+                    f"Embedding dimension {embeddings.shape[1]} doesn't match the store's dimension {self.dim}"
+                )
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                with open(self._meta_path, "w") as f:
+                    json.dump({"dim": self.dim, "dtype": self.dtype}, f)
+            quantized, scales = self._quantize(embeddings)
+            first_row = self._num_rows()
+            with open(self._vectors_path, "ab") as f:
+                f.write(quantized.tobytes())
+            if self.dtype == "int8":
+                with open(self._scales_path, "ab") as f:
+                    f.write(scales.tobytes())
+            if self._centroids is not None:
+                lists = np.argmax(quantized.astype(np.float32) @ self._centroids.T, axis=1)
+                with open(self._lists_path, "ab") as f:
+                    f.write(lists.astype(np.int32).tobytes())
+
+            ids = [result.id for result in embedding_results]
+            # Re-adding a node replaces it
+            self._conn.executemany(
+                "UPDATE nodes SET deleted = 1 WHERE node_id = ?",
+                [(node_id,) for node_id in ids],
+            )
+            self._conn.executemany(
+                "INSERT INTO nodes (row, node_id, ref_doc_id, node) VALUES (?, ?, ?, ?)",
+                [
+                    (first_row + i, result.id, result.ref_doc_id, result.node.json())
+                    for i, result in enumerate(embedding_results)
+                ],
+            )
+            self._conn.commit()
+            self._live_rows = None
+        return ids
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        with self._file_lock(), self._lock:
+            self._conn.execute("UPDATE nodes SET deleted = 1 WHERE ref_doc_id = ?", (ref_doc_id,))
+            self._conn.commit()
+            self._live_rows = None
+
+    def delete_nodes(self, node_ids: List[str]) -> None:
+        with self._file_lock(), self._lock:
+            self._conn.executemany(
+                "UPDATE nodes SET deleted = 1 WHERE node_id = ?", [(node_id,) for node_id in node_ids]
+            )
+            self._conn.commit()
+            self._live_rows = None
+
+    def _allowed_rows(self, query: VectorStoreQuery, num_rows: int) -> np.ndarray:
+        unfiltered = not query.doc_ids and not query.node_ids
+        if unfiltered and self._live_rows is not None and len(self._live_rows) == num_rows:
+            return self._live_rows
+        sql = "SELECT row FROM nodes WHERE deleted = 0"
+        params: list = []
+        if query.doc_ids:
+            sql += f" AND ref_doc_id IN ({','.join('?' * len(query.doc_ids))})"
+            params.extend(query.doc_ids)
+        if query.node_ids:
+            sql += f" AND node_id IN ({','.join('?' * len(query.node_ids))})"
+            params.extend(query.node_ids)
+        allowed = np.zeros(num_rows, dtype=bool)
+        rows = [row for (row,) in self._conn.execute(sql, params)]
+        allowed[rows] = True
+        if unfiltered:
+            self._live_rows = allowed
+        return allowed
+
+    def _candidate_rows(self, queries: np.ndarray, num_rows: int) -> Optional[np.ndarray]:
+        """Rows in the n_probe closest IVF lists to any of the queries, or None for a flat scan."""
+        if self._centroids is None or not os.path.isfile(self._lists_path):
+            return None
+        lists = np.memmap(self._lists_path, dtype=np.int32, mode="r")[:num_rows]
+        closest = np.argsort(-(queries @ self._centroids.T), axis=1)[:, : self.n_probe]
+        return np.nonzero(np.isin(lists, np.unique(closest)))[0]
+
+    def query_batch(self, query_embeddings: List[List[float]], similarity_top_k: int, query: Optional[VectorStoreQuery] = None) -> List[VectorStoreQueryResult]:
+        """Top-k for several queries in one pass over the vectors."""
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        # Compaction in another process renumbers the rows, so it must wait for the query
+        with self._file_lock(exclusive=False):
+            return self._query_batch(queries, similarity_top_k, query)
+
+    def _query_batch(self, queries: np.ndarray, similarity_top_k: int, query: Optional[VectorStoreQuery]) -> List[VectorStoreQueryResult]:
+        with self._lock:
+            self._refresh()
+            num_rows = self._num_rows()
+            if num_rows == 0:
+                return [VectorStoreQueryResult(nodes=[], similarities=[], ids=[]) for _ in queries]
+            allowed = self._allowed_rows(query or VectorStoreQuery(), num_rows)
+
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+
+        def merge(rows: np.ndarray, scores: np.ndarray):
+            nonlocal best_scores, best_rows
+            scores = np.where(allowed[rows][None, :], scores, -np.inf)
+            all_scores = np.concatenate([best_scores, scores], axis=1)
+            all_rows = np.concatenate([best_rows, np.broadcast_to(rows, scores.shape)], axis=1)
+            k = min(similarity_top_k, all_scores.shape[1])
+            top = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(all_scores, top, axis=1)
+            best_rows = np.take_along_axis(all_rows, top, axis=1)
+
+        candidates = self._candidate_rows(queries, num_rows)
+        if candidates is None:
+            for start in range(0, num_rows, BLOCK_ROWS):
+                stop = min(start + BLOCK_ROWS, num_rows)
+                merge(np.arange(start, stop), queries @ self._load_rows(slice(start, stop)).T)
+        else:
+            for start in range(0, len(candidates), BLOCK_ROWS):
+                rows = candidates[start : start + BLOCK_ROWS]
+                merge(rows, queries @ self._load_rows(rows).T)
+
+        return [self._to_result(rows, scores) for rows, scores in zip(best_rows, best_scores)]
+
+    def _to_result(self, rows: np.ndarray, scores: np.ndarray) -> VectorStoreQueryResult:
+        order = np.argsort(-scores)
+        rows, scores = rows[order], scores[order]
+        keep = np.isfinite(scores)
+        rows, scores = rows[keep], scores[keep]
+        with self._lock:
+            found = {
+                row: (node_id, node)
+                for row, node_id, node in self._conn.execute(
+                    f"SELECT row, node_id, node FROM nodes WHERE row IN ({','.join('?' * len(rows))})",
+                    [int(row) for row in rows],
+                )
+            }
+        return VectorStoreQueryResult(
+            nodes=[TextNode.parse_raw(found[int(row)][1]) for row in rows],
+            similarities=[float(score) for score in scores],
+            ids=[found[int(row)][0] for row in rows],
+        )
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        return self.query_batch([query.query_embedding], query.similarity_top_k, query)[0]
+
+    def compact(self) -> dict:
+        """Rewrites the vector files without deleted rows and renumbers the remaining nodes."""
+        with self._file_lock(), self._lock:
+            return self._compact()
+
+    def _compact(self) -> dict:
+        self._refresh()
+        before = self._num_rows()
+        live = np.asarray(
+            [row for (row,) in self._conn.execute("SELECT row FROM nodes WHERE deleted = 0 ORDER BY row")],
+            dtype=np.int64,
+        )
+        if len(live) == before:
+            return {"rows_before": before, "rows_after": before}
+
+        files = [(self._vectors_path, DTYPES[self.dtype], self.dim)]
+        if self.dtype == "int8":
+            files.append((self._scales_path, np.float32, 1))
+        if os.path.isfile(self._lists_path):
+            files.append((self._lists_path, np.int32, 1))
+        for path, dtype, width in files:
+            data = np.memmap(path, dtype=dtype, mode="r").reshape(-1, width)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                for start in range(0, len(live), BLOCK_ROWS):
+                    f.write(np.ascontiguousarray(data[live[start : start + BLOCK_ROWS]]).tobytes())
+            del data
+            os.replace(tmp_path, path)
+
+        self._conn.execute("DELETE FROM nodes WHERE deleted = 1")
+        # Ascending order, so a row never moves onto one that is still in use
+        self._conn.executemany(
+            "UPDATE nodes SET row = ? WHERE row = ?",
+            [(new_row, int(old_row)) for new_row, old_row in enumerate(live)],
+        )
+        self._conn.commit()
+        self._live_rows = None
+        logger.info(f"Compacted local index from {before} to {len(live)} rows")
+        return {"rows_before": before, "rows_after": len(live)}
+
+    def build_ivf(self, n_lists: int = 256, iterations: int = 10, sample_size: int = 50_000, seed: int = 0) -> None:
+        """Drops deleted rows, then clusters the vectors with k-means so queries only scan the closest lists."""
+        with self._file_lock(), self._lock:
+            self._compact()
+            num_rows = self._num_rows()
+            if num_rows == 0:
+                return
+            rng = np.random.default_rng(seed)
+            sample_rows = np.sort(rng.choice(num_rows, size=min(sample_size, num_rows), replace=False))
+            sample = self._load_rows(sample_rows)
+            n_lists = min(n_lists, len(sample))
+            centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+            for _ in range(iterations):
+                assignment = np.argmax(sample @ centroids.T, axis=1)
+                for i in range(n_lists):
+                    members = sample[assignment == i]
+                    if len(members):
+                        centroid = members.mean(axis=0)
+                        centroids[i] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+            with open(self._lists_path, "wb") as f:
+                for start in range(0, num_rows, BLOCK_ROWS):
+                    block = self._load_rows(slice(start, min(start + BLOCK_ROWS, num_rows)))
+                    f.write(np.argmax(block @ centroids.T, axis=1).astype(np.int32).tobytes())
+            np.save(self._centroids_path, centroids)
+            self._centroids = centroids
+        logger.info(f"Built IVF index with {n_lists} lists over {num_rows} vectors")
@@ -1,12 +1,24 @@
 import os
+import argparse
+import json
 import logging
-import pandas as pd
-from agent import get_improved_page
+import socket
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from agent import refine_page, RefinementLimits, llm_cache, model_settings, TEMPLATES
+from manifest import Manifest, fingerprint, hash_text
+from corpus_store import open_corpus
 from utils import LANGCHAIN_BASE, save_output, get_langchain_docs_url, get_all_paths
 from tqdm import tqdm
-from vector_store import pinecone_vector_stores, get_index
-from llama_index.retrievers import VectorIndexRetriever
-import tiktoken
+from retrieval import ContextRetriever, LARGE_PAGE_MODES
+from prompt_budget import PromptBudgeter
+from backends import BACKEND, is_offline
+from instrumentation import metrics
+from artifact_store import ArtifactStore
+from job_queue import JobQueue, LeaseKeeper, DEFAULT_QUEUE_PATH
+from rate_limit import rate_limits
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)-4s [%(filename)s:%(lineno)d] %(message)s",
@@ -15,64 +27,444 @@ logging.basicConfig(
 )
 
 SAVE_DIR = "langdocs/docs/"
+METRICS_DIR = "src/output/metrics"
 
-def get_args(reference_df):
-    reference_doc = reference_df["content"].iloc[0]
-    
-    encoding = tiktoken.get_encoding('cl100k_base')
-    num_tokens = len(encoding.encode(reference_doc))
-    retrievel_ref_doc = reference_doc
-    
-    if num_tokens > 8000:
-        print("Split large reference doc")
-        retrievel_ref_doc = reference_doc[:len(reference_doc)//2]
-    
+def get_reference_page_name(url):
     reference_page_name = (
-        reference_df["url"].iloc[0].split(LANGCHAIN_BASE + "/")[1]
+        url.split(LANGCHAIN_BASE + "/")[1]
     )  # will return something like /modules/chains/how_to/memory.md'
     
     # If the reference page name is empty, it will default to the index page
     if reference_page_name[-1] == "/":
         reference_page_name += "index"
-
-    index = get_index(pinecone_vector_stores["official"])
-    retriever = VectorIndexRetriever(index=index, similarity_top_k=8)
-    
-    similar_nodes_with_scores = retriever.retrieve(retrievel_ref_doc)
-    similar_nodes = [n.node for n in similar_nodes_with_scores]
-    text_from_nodes = [node.text for node in similar_nodes]
-    
-    context = "\n\n".join(text_from_nodes)
-    return reference_doc, context, reference_page_name
+    return reference_page_name
 
 
-def main():
-    skip_existing = True
-
-    df = pd.read_csv("src/data/data.csv")
-    urls = get_langchain_docs_url()
+def prepare_pages(urls, corpus, retriever, budgeter, batch_size=32):
+    """Retrieves the context of every page up front so the LLM stage never waits on retrieval.
 
+    Returns a dict of url -> (reference_doc, contexts per template, reference_page_name)
+    and the urls that failed.
+    """
+    pages = {}
     errors = []
-    for url in tqdm(urls):
-        # Trigger deployment
+    sources = []
+    with metrics.span("corpus_lookup", urls=len(urls)):
+        for url in urls:
+            source = corpus.get(url)
+            if source is None:
+                errors.append(url)
+                print(f"No crawled content for {url}, run scripts/crawl.py first")
+            else:
+                sources.append(source)
+
+    for i in tqdm(range(0, len(sources), batch_size), desc="Retrieving context"):
+        batch = sources[i : i + batch_size]
         try:
-            reference_df = df[df["url"] == url]
-            reference_doc, context, reference_page_name = get_args(reference_df)
-            
-            output_path = f"{SAVE_DIR}/{reference_page_name}.md"
-            if skip_existing and os.path.isfile(output_path):
-                print(f"File {reference_page_name} already exists")
+            with metrics.span("retrieval", pages=len(batch)):
+                results = retriever.retrieve_pages([source.content for source in batch])
+        except Exception as e:
+            errors.extend(source.url for source in batch)
+            print(f"Encountered an error retrieving context for {len(batch)} pages: {e}")
+            continue
+        for source, nodes_with_scores in zip(batch, results):
+            reference_page_name = get_reference_page_name(source.url)
+            with metrics.page(reference_page_name), metrics.span("context_packing"):
+                contexts = budgeter.pack(nodes_with_scores, reference_page_name)
+            pages[source.url] = (source.content, contexts, reference_page_name)
+    return pages, errors
+
+
+def improve_url(page_args, manifest, skip_existing=True, dry_run=False, adopt_existing=False, stream=False, limits=None, artifacts=None, publish=True):
+    """Improves a single page if its inputs changed since the last run.
+
+    Outputs are committed to the artifacts run when given, otherwise written as files.
+    Returns the list of changed inputs (empty if the page was skipped), the
+    RefinementResult, or None if the LLM wasn't called, and a function that writes the
+    outputs and the manifest entry, or None if there is nothing to write. With publish
+    it has already been called; the queue worker calls it itself while holding the lease.
+    """
+    reference_doc, context, reference_page_name = page_args
+    with metrics.page(reference_page_name):
+        changes, result, write = _improve_page(reference_doc, context, reference_page_name, manifest, skip_existing, dry_run, adopt_existing, stream, limits, artifacts)
+    if publish and write is not None:
+        write()
+    return changes, result, write
+
+
+def _improve_page(reference_doc, context, reference_page_name, manifest, skip_existing, dry_run, adopt_existing, stream, limits, artifacts):
+    output_path = f"{SAVE_DIR}/{reference_page_name}.md"
+    page_fingerprint = fingerprint(reference_doc, context, TEMPLATES, model_settings())
+    changes = manifest.changes(reference_page_name, page_fingerprint)
+    if adopt_existing and changes == ["new"] and os.path.isfile(output_path):
+        # Pages generated before the manifest existed are assumed to be up to date
+        def adopt():
+            manifest.record(reference_page_name, page_fingerprint)
+            manifest.save()
+        return [], None, (None if dry_run else adopt)
+    if not os.path.isfile(output_path):
+        changes = changes or ["missing output"]
+    elif not skip_existing:
+        changes = changes or ["forced"]
+
+    if not changes:
+        return [], None, None
+    if dry_run:
+        print(f"Would rebuild {reference_page_name}: {', '.join(changes)}")
+        return changes, None, None
+
+    try:
+        result = refine_page(reference_doc, context, reference_page_name, limits, stream=stream, artifacts=artifacts)
+    except Exception:
+        if artifacts is not None:
+            artifacts.discard_page(reference_page_name)
+        raise
+    if result.rounds == 0:
+        # Stopped before any improvement, so result.page is still the reference page. The
+        # existing output and manifest entry are left alone and the page is tried again next run.
+        if artifacts is not None:
+            artifacts.discard_page(reference_page_name)
+        print(f"Not rebuilding {reference_page_name}, stopped before improving it: {result.stop_reason}")
+        return changes, result, None
+
+    def write():
+        with metrics.page(reference_page_name):
+            if artifacts is not None:
+                artifacts.put(reference_page_name, "v0", reference_doc)
+                # Blocks until the page is in the store, a failed write fails the page before it is recorded
+                artifacts.commit_page(reference_page_name, result.page)
+            else:
+                save_output(f"src/output/v0/{reference_page_name}.md", reference_doc)
+            # The Markdown goes out before the manifest entry, so a crash in between only
+            # means the page is rebuilt next run, never that a recorded page is missing
+            save_output(output_path, result.page)
+            manifest.record(
+                reference_page_name,
+                page_fingerprint,
+                rounds=result.rounds,
+                calls=result.calls,
+                tokens=result.tokens,
+                stop_reason=result.stop_reason,
+            )
+            manifest.save()
+    return changes, result, write
+
+
+def page_status(changes, result):
+    if not changes:
+        return "skipped"
+    if result is not None and result.rounds == 0:
+        return "not_improved"
+    return "rebuilt"
+
+
+def main(skip_existing=True, max_workers=1, dry_run=False, adopt_existing=False, large_page_mode="multi_chunk", context_budgets=None, stream=False, limits=None, metrics_path=None, prometheus_path=None, queue_path=None, worker_id=None, reset_queue=False):
+    metrics_path = metrics_path or f"{METRICS_DIR}/{time.strftime('%Y%m%d-%H%M%S')}.jsonl"
+    metrics.start(metrics_path)
+    try:
+        if queue_path:
+            worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+            return run_worker(queue_path, worker_id, skip_existing, max_workers, adopt_existing, large_page_mode, context_budgets, stream, limits, reset_queue)
+        return run(skip_existing, max_workers, dry_run, adopt_existing, large_page_mode, context_budgets, stream, limits)
+    finally:
+        metrics.close()
+        print(metrics.summary_table())
+        if metrics.counters:
+            print(f"Counters: {metrics.counters}")
+        print(f"Rate limits: {rate_limits.stats()}")
+        print(f"Timings written to {metrics_path}")
+        if prometheus_path:
+            metrics.write_prometheus(prometheus_path)
+
+
+def discover_urls(corpus):
+    with metrics.span("discovery"):
+        if is_offline():
+            # No GitHub discovery without network, use the pages crawled earlier instead
+            urls = [url for url in corpus.urls() if url.startswith(LANGCHAIN_BASE)]
+            print(f"{BACKEND} backend: using {len(urls)} urls from the corpus store")
+            return urls
+        return get_langchain_docs_url()
+
+
+def run(skip_existing, max_workers, dry_run, adopt_existing, large_page_mode, context_budgets, stream, limits):
+    corpus = open_corpus()
+    urls = discover_urls(corpus)
+    manifest = Manifest()
+    retriever = ContextRetriever(large_page_mode=large_page_mode)
+
+    budgeter = PromptBudgeter(context_budgets)
+
+    pages, errors = prepare_pages(urls, corpus, retriever, budgeter)
+    artifact_store = ArtifactStore()
+    artifacts = None if dry_run else artifact_store.start_run(model_settings())
+    rebuilt = []
+    refinements = []
+    # Pages are independent and almost all of the time is spent waiting on Claude,
+    # so a thread pool gives close to linear speedup until we hit the rate limit.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                improve_url, page_args, manifest, skip_existing, dry_run, adopt_existing, stream, limits, artifacts
+            ): url
+            for url, page_args in pages.items()
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            url = futures[future]
+            try:
+                changes, result, _ = future.result()
+                status = page_status(changes, result)
+                metrics.count(f"pages_{status}")
+                if status == "rebuilt":
+                    rebuilt.append(url)
+                if result is not None:
+                    refinements.append(result)
+            except Exception as e:
+                metrics.count("pages_failed")
+                errors.append(url)
+                print(f"Encountered an error for url {url} improving page: {e}")
+
+    if artifacts is not None:
+        # Pages are already in SAVE_DIR, this only waits for the remaining artifact writes
+        artifact_store.flush()
+    artifact_store.close()
+
+    verb = "Would rebuild" if dry_run else "Rebuilt"
+    print(f"{verb} {len(rebuilt)} of {len(urls)} pages")
+    if refinements:
+        average_calls = sum(r.calls for r in refinements) / len(refinements)
+        stop_reasons = Counter(r.stop_reason for r in refinements)
+        print(f"Average LLM calls per page: {average_calls:.1f}, stop reasons: {dict(stop_reasons)}")
+    print(f"LLM cache stats: {llm_cache.stats()}")
+    if errors:
+        print(f"Failed to improve {len(errors)} pages: {errors}")
+    return errors
+
+
+def job_versions(urls, corpus):
+    """Hash of each page's crawled content, templates and model settings.
+
+    Seeding with these reopens finished jobs whose page changed. The retrieved context
+    isn't known until a page is prepared, so changes to it alone don't reopen a job.
+    """
+    versions = {}
+    for url in urls:
+        source = corpus.get(url)
+        if source is not None:
+            versions[url] = hash_text(json.dumps(fingerprint(source.content, "", TEMPLATES, model_settings()), sort_keys=True))
+    return versions
+
+
+def run_worker(queue_path, worker_id, skip_existing, max_workers, adopt_existing, large_page_mode, context_budgets, stream, limits, reset_queue=False):
+    """Drains the shared job queue together with any other workers using it.
+
+    Each page is leased before it is improved and its outputs and manifest entry are
+    only written while the lease is still held, so no two workers publish the same page.
+    """
+    corpus = open_corpus()
+    job_queue = JobQueue(queue_path)
+    urls = discover_urls(corpus)
+    added = job_queue.seed(urls, reset=reset_queue, versions=job_versions(urls, corpus))
+    print(f"Worker {worker_id}: added or reopened {added} jobs, queue {job_queue.counts()}")
+
+    manifest = Manifest()
+    retriever = ContextRetriever(large_page_mode=large_page_mode)
+    budgeter = PromptBudgeter(context_budgets)
+    artifact_store = ArtifactStore()
+    artifacts = artifact_store.start_run({**model_settings(), "worker_id": worker_id})
+    completed, errors = [], []
+
+    with LeaseKeeper(job_queue) as keeper, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            leases = job_queue.lease(worker_id, n=max_workers)
+            if not leases:
+                if not job_queue.counts().get("leased"):
+                    break
+                # Other workers hold the remaining jobs, keep polling in case their leases expire
+                time.sleep(min(job_queue.lease_seconds / 10, 30))
                 continue
+            for lease in leases:
+                keeper.add(lease)
 
-            output = get_improved_page(reference_doc, context, reference_page_name)
+            pages, _ = prepare_pages([lease.url for lease in leases], corpus, retriever, budgeter)
+            futures = {}
+            for lease in leases:
+                if lease.url in pages:
+                    futures[executor.submit(
+                        improve_url, pages[lease.url], manifest, skip_existing, False, adopt_existing, stream, limits, artifacts, False
+                    )] = lease
+                else:
+                    keeper.remove(lease)
+                    job_queue.fail(lease, "no crawled content or context")
+                    errors.append(lease.url)
 
-            save_output(f"src/output/v0/{reference_page_name}.md", reference_doc)
-            save_output(output_path, output)
-            
-        except Exception as e:
-            errors.append(url)
-            print(f"Encountered an error for url {url} improving page: {e}")
+            for future in as_completed(futures):
+                lease = futures[future]
+                keeper.remove(lease)
+                try:
+                    changes, result, write = future.result()
+                except Exception as e:
+                    metrics.count("pages_failed")
+                    job_queue.fail(lease, str(e))
+                    errors.append(lease.url)
+                    print(f"Encountered an error for url {lease.url} improving page: {e}")
+                    continue
+
+                reference_page_name = pages[lease.url][2]
+                details = {"changes": changes, "stop_reason": result.stop_reason if result else None}
+                try:
+                    published = job_queue.complete(lease, details, write=write)
+                except Exception as e:
+                    metrics.count("pages_failed")
+                    job_queue.fail(lease, str(e))
+                    errors.append(lease.url)
+                    print(f"Encountered an error for url {lease.url} publishing page: {e}")
+                    continue
+                if not published:
+                    artifacts.discard_page(reference_page_name)
+                    metrics.count("leases_lost")
+                    print(f"Lease on {lease.url} expired before it finished, another worker owns it now")
+                    continue
+                metrics.count(f"pages_{page_status(changes, result)}")
+                completed.append(lease.url)
+
+    artifact_store.close()
+    print(f"Worker {worker_id} finished {len(completed)} pages, queue {job_queue.counts()}")
+    if errors:
+        print(f"Failed to improve {len(errors)} pages: {errors}")
+    return errors
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of pages to improve in parallel",
+    )
+    parser.add_argument(
+        "--no-skip-existing",
+        dest="skip_existing",
+        action="store_false",
+        help="Regenerate every page, even if its inputs did not change",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Report which pages would be rebuilt without calling the LLM",
+    )
+    parser.add_argument(
+        "--adopt-existing",
+        action="store_true",
+        help="Record pages that already exist but have no manifest entry instead of rebuilding them",
+    )
+    parser.add_argument(
+        "--large-page-mode",
+        choices=LARGE_PAGE_MODES,
+        default="multi_chunk",
+        help="How to query context for pages too large to embed in one go",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream completions, writing partial output to src/output/partial as it arrives",
+    )
+    defaults = RefinementLimits()
+    parser.add_argument(
+        "--max-rounds",
+        type=int,
+        default=defaults.max_rounds,
+        help="Maximum improve rounds per page",
+    )
+    parser.add_argument(
+        "--min-change",
+        type=float,
+        default=defaults.min_change,
+        help="Stop refining once a round changes less than this fraction of the page",
+    )
+    parser.add_argument(
+        "--max-calls",
+        type=int,
+        help="Maximum LLM calls per page",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        help="Maximum prompt plus completion tokens per page",
+    )
+    parser.add_argument(
+        "--no-early-stop",
+        dest="early_stop",
+        action="store_false",
+        help="Always run --max-rounds rounds, ignoring convergence and clean critiques",
+    )
+    parser.add_argument(
+        "--metrics-path",
+        help=f"JSONL file for per-page, per-stage timings and tokens (default: a new file in {METRICS_DIR})",
+    )
+    parser.add_argument(
+        "--prometheus-file",
+        help="Also write the run totals to this file in the Prometheus text format",
+    )
+    parser.add_argument(
+        "--queue",
+        nargs="?",
+        const=DEFAULT_QUEUE_PATH,
+        dest="queue_path",
+        help=f"Take pages from a job queue shared with other workers (default {DEFAULT_QUEUE_PATH})",
+    )
+    parser.add_argument(
+        "--worker-id",
+        help="Name of this worker in the job queue, defaults to hostname-pid",
+    )
+    parser.add_argument(
+        "--reset-queue",
+        action="store_true",
+        help="With --queue, drop every job, including finished ones, and seed the queue again. "
+        "Only use it while no other worker is running",
+    )
+    for stage in TEMPLATES:
+        parser.add_argument(
+            f"--{stage.replace('_', '-')}-context-tokens",
+            type=int,
+            dest=f"{stage}_context_tokens",
+            help=f"Token budget for the retrieved context in the {stage} prompt",
+        )
+    args = parser.parse_args()
+    if args.queue_path and args.dry_run:
+        parser.error("--dry-run can't be combined with --queue")
+    if args.reset_queue and not args.queue_path:
+        parser.error("--reset-queue requires --queue")
+    return args
 
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    errors = main(
+        skip_existing=args.skip_existing,
+        max_workers=args.concurrency,
+        dry_run=args.dry_run,
+        adopt_existing=args.adopt_existing,
+        large_page_mode=args.large_page_mode,
+        context_budgets={
+            stage: getattr(args, f"{stage}_context_tokens")
+            for stage in TEMPLATES
+            if getattr(args, f"{stage}_context_tokens") is not None
+        },
+        stream=args.stream,
+        limits=RefinementLimits(
+            max_rounds=args.max_rounds,
+            min_change=args.min_change if args.early_stop else 0.0,
+            stop_on_clean_critique=args.early_stop,
+            max_calls=args.max_calls,
+            max_tokens=args.max_tokens,
+        ),
+        metrics_path=args.metrics_path,
+        prometheus_path=args.prometheus_file,
+        queue_path=args.queue_path,
+        worker_id=args.worker_id,
+        reset_queue=args.reset_queue,
+    )
+    if errors:
+        sys.exit(1)
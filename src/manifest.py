@@ -0,0 +1,83 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Union
+
+DEFAULT_MANIFEST_PATH = "src/data/manifest.json"
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def fingerprint(reference_doc: str, context: Union[str, Dict[str, str]], templates: Dict[str, str], model_settings: dict) -> dict:
+    """Hashes of every input that affects the generated page."""
+    if not isinstance(context, str):
+        context = json.dumps(context, sort_keys=True)
+    return {
+        "reference": hash_text(reference_doc),
+        "context": hash_text(context),
+        "templates": {name: hash_text(template) for name, template in templates.items()},
+        "model": model_settings,
+    }
+
+
+class Manifest:
+    """Records the inputs each page was last generated from, so unchanged pages can be skipped."""
+
+    def __init__(self, path: str = DEFAULT_MANIFEST_PATH) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.pages: Dict[str, dict] = self._load()
+        # Pages recorded by this process, the only ones save() may overwrite
+        self._recorded = set()
+
+    def _load(self) -> Dict[str, dict]:
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def changes(self, page_name: str, page_fingerprint: dict) -> List[str]:
+        """Returns the inputs that differ from the last recorded run. Empty means up to date."""
+        with self._lock:
+            previous = self.pages.get(page_name)
+        if previous is None:
+            return ["new"]
+        changed = [
+            field
+            for field in ("reference", "context", "model")
+            if previous.get(field) != page_fingerprint[field]
+        ]
+        previous_templates = previous.get("templates", {})
+        changed.extend(
+            f"template:{name}"
+            for name, digest in page_fingerprint["templates"].items()
+            if previous_templates.get(name) != digest
+        )
+        return changed
+
+    def record(self, page_name: str, page_fingerprint: dict, **details) -> None:
+        """Stores the fingerprint, plus any details about the run (not compared by changes)."""
+        with self._lock:
+            self.pages[page_name] = {**page_fingerprint, **details, "generated_at": time.time()}
+            self._recorded.add(page_name)
+
+    def save(self) -> None:
+        """Writes the manifest, merging in pages other processes recorded since it was loaded."""
+        with self._lock:
+            parent_dir = os.path.dirname(self.path)
+            if parent_dir:
+                os.makedirs(parent_dir, exist_ok=True)
+            with open(f"{self.path}.lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                pages = self._load()
+                pages.update({page: self.pages[page] for page in self._recorded})
+                self.pages = pages
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(self.pages, f, indent=2, sort_keys=True)
+                os.replace(tmp_path, self.path)
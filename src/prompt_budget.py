@@ -0,0 +1,91 @@
+import logging
+import re
+from typing import Dict, List, Optional, Set
+
+from llama_index.schema import NodeWithScore
+
+from embedding import count_tokens
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_SEPARATOR = "\n\n"
+# Context tokens allowed per template. Critiques of the improved page need the least
+# context since the page itself already carries most of it.
+DEFAULT_BUDGETS = {
+    "initial_critique": 6000,
+    "improve": 6000,
+    "critique": 4000,
+}
+# Chunks whose word shingles overlap more than this are considered the same
+DUPLICATE_THRESHOLD = 0.8
+SHINGLE_SIZE = 5
+
+
+def _shingles(text: str) -> Set[str]:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {" ".join(words[i : i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def dedupe_nodes(nodes_with_scores: List[NodeWithScore], threshold: float = DUPLICATE_THRESHOLD) -> List[NodeWithScore]:
+    """Drops chunks that are near duplicates of a higher scored chunk."""
+    kept: List[NodeWithScore] = []
+    kept_shingles: List[Set[str]] = []
+    for node_with_score in sort_by_score(nodes_with_scores):
+        shingles = _shingles(node_with_score.node.get_content())
+        if any(
+            len(shingles & other) / max(len(shingles | other), 1) > threshold
+            for other in kept_shingles
+        ):
+            continue
+        kept.append(node_with_score)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def sort_by_score(nodes_with_scores: List[NodeWithScore]) -> List[NodeWithScore]:
+    # Stores that don't return scores keep their retrieval order
+    return sorted(
+        nodes_with_scores,
+        key=lambda n: n.score if n.score is not None else float("-inf"),
+        reverse=True,
+    )
+
+
+def pack_context(nodes_with_scores: List[NodeWithScore], budget_tokens: int) -> str:
+    """Joins the best scored chunks that fit within budget_tokens."""
+    packed: List[str] = []
+    used = 0
+    separator_tokens = count_tokens(CONTEXT_SEPARATOR)
+    for node_with_score in sort_by_score(nodes_with_scores):
+        text = node_with_score.node.get_content()
+        tokens = count_tokens(text) + (separator_tokens if packed else 0)
+        if used + tokens > budget_tokens:
+            continue
+        packed.append(text)
+        used += tokens
+    return CONTEXT_SEPARATOR.join(packed)
+
+
+class PromptBudgeter:
+    """Builds the context for each agent template within that template's token budget."""
+
+    def __init__(self, budgets: Optional[Dict[str, int]] = None, duplicate_threshold: float = DUPLICATE_THRESHOLD) -> None:
+        self.budgets = {**DEFAULT_BUDGETS, **(budgets or {})}
+        self.duplicate_threshold = duplicate_threshold
+
+    def pack(self, nodes_with_scores: List[NodeWithScore], page_name: str = "") -> Dict[str, str]:
+        full_tokens = count_tokens(
+            CONTEXT_SEPARATOR.join(n.node.get_content() for n in nodes_with_scores)
+        )
+        unique = dedupe_nodes(nodes_with_scores, self.duplicate_threshold)
+        contexts = {
+            stage: pack_context(unique, budget) for stage, budget in self.budgets.items()
+        }
+        saved = {stage: full_tokens - count_tokens(context) for stage, context in contexts.items()}
+        logger.info(
+            f"Packed context for {page_name}: {len(nodes_with_scores) - len(unique)} duplicate chunks dropped, "
+            f"tokens saved per call {saved}"
+        )
+        return contexts
@@ -0,0 +1,344 @@
+import email.utils
+import logging
+import os
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Dict, Mapping, Optional, TypeVar
+
+from instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@dataclass
+class ProviderLimits:
+    requests_per_minute: float
+    # None for providers that only limit the number of requests
+    tokens_per_minute: Optional[float] = None
+
+
+# Conservative defaults, override with e.g. ANTHROPIC_RPM=1000 ANTHROPIC_TPM=200000.
+# Rate limit headers tighten these at runtime but never loosen them past the configured values.
+DEFAULT_LIMITS = {
+    "anthropic": ProviderLimits(requests_per_minute=50, tokens_per_minute=100_000),
+    "openai": ProviderLimits(requests_per_minute=3000, tokens_per_minute=1_000_000),
+    # 5000 requests per hour for authenticated requests
+    "github": ProviderLimits(requests_per_minute=5000 / 60),
+}
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+MAX_BACKOFF = 120.0
+# Fraction of the configured rate that a 429 leaves, and how much of it each success wins back
+DECREASE_FACTOR = 0.7
+RECOVERY_STEP = 0.02
+MIN_RATE_FRACTION = 0.1
+
+DURATION_PATTERN = re.compile(r"(?:(\d+(?:\.\d+)?)h)?(?:(\d+(?:\.\d+)?)m(?!s))?(?:(\d+(?:\.\d+)?)s)?(?:(\d+(?:\.\d+)?)ms)?$")
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, given as seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """Seconds until a rate limit resets. Handles epoch seconds (GitHub),
+    durations like "6m0s" or "20ms" (OpenAI) and RFC 3339 timestamps (Anthropic)."""
+    if not value:
+        return None
+    try:
+        number = float(value)
+        # Epoch timestamps are far larger than any sensible delay
+        return max(number - time.time(), 0.0) if number > 1e9 else max(number, 0.0)
+    except ValueError:
+        pass
+    match = DURATION_PATTERN.match(value.strip())
+    if match and any(match.groups()):
+        hours, minutes, seconds, millis = (float(g) if g else 0.0 for g in match.groups())
+        return hours * 3600 + minutes * 60 + seconds + millis / 1000
+    try:
+        return max(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() - time.time(), 0.0)
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """Token bucket where callers reserve capacity up front and are told how long to wait for it.
+
+    Reservations may drive the balance negative, which queues later callers behind
+    earlier ones instead of letting them race for the next refill.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.max_rate = self.rate
+        self._balance = per_minute
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._balance = min(self.capacity, self._balance + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Takes amount from the bucket and returns the seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # A single request larger than the whole bucket would otherwise never fit
+            self._balance -= min(amount, self.capacity)
+            return 0.0 if self._balance >= 0 else -self._balance / self.rate
+
+    def set_rate(self, per_minute: float) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(min(per_minute / 60, self.max_rate), self.max_rate * MIN_RATE_FRACTION)
+
+    def drain(self) -> None:
+        """Empties the bucket, for when the provider reports nothing is left."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._balance = min(self._balance, 0.0)
+
+
+class ProviderLimiter:
+    """Request and token budgets of one provider, shared by every thread and task that calls it."""
+
+    def __init__(self, name: str, limits: ProviderLimits, enabled: bool = True) -> None:
+        self.name = name
+        self.limits = limits
+        self.enabled = enabled
+        self.requests = TokenBucket(limits.requests_per_minute)
+        self.tokens = TokenBucket(limits.tokens_per_minute) if limits.tokens_per_minute else None
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self._consecutive_limited = 0
+        self.rate_limited = 0
+        self.transient_errors = 0
+        self.waited = 0.0
+
+    def _reserve(self, tokens: int) -> float:
+        if not self.enabled:
+            return 0.0
+        wait = self.requests.reserve(1)
+        if self.tokens is not None and tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        with self._lock:
+            wait = max(wait, self._paused_until - time.monotonic())
+            self.waited += max(wait, 0.0)
+        return max(wait, 0.0)
+
+    def acquire(self, tokens: int = 0) -> None:
+        """Blocks until a request of about this many tokens is allowed."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _back_off(self, retry_after: Optional[float]) -> float:
+        """Honours Retry-After, otherwise backs off exponentially with jitter."""
+        with self._lock:
+            self._consecutive_limited += 1
+            attempt = self._consecutive_limited
+        if retry_after is None:
+            retry_after = min(BACKOFF_BASE * 2 ** (attempt - 1), MAX_BACKOFF) * random.uniform(0.5, 1.0)
+        self.pause(retry_after)
+        return retry_after
+
+    def on_rate_limited(self, retry_after: Optional[float] = None) -> float:
+        """Backs off after a 429 and lowers the request rate until calls succeed again.
+        Returns the pause in seconds."""
+        with self._lock:
+            self.rate_limited += 1
+        retry_after = self._back_off(retry_after)
+        self.requests.set_rate(self.requests.rate * 60 * DECREASE_FACTOR)
+        self.requests.drain()
+        logger.warning(f"{self.name} rate limited, pausing {retry_after:.1f}s")
+        return retry_after
+
+    def on_transient_error(self, error: Exception, retry_after: Optional[float] = None) -> float:
+        """Backs off after an overloaded, failing or unreachable provider, keeping the request rate."""
+        with self._lock:
+            self.transient_errors += 1
+        retry_after = self._back_off(retry_after)
+        logger.warning(f"{self.name} unavailable ({type(error).__name__}), pausing {retry_after:.1f}s")
+        return retry_after
+
+    def on_success(self) -> None:
+        with self._lock:
+            self._consecutive_limited = 0
+        if self.requests.rate < self.requests.max_rate:
+            self.requests.set_rate((self.requests.rate + self.requests.max_rate * RECOVERY_STEP) * 60)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """Adapts to the limits the provider reports (Anthropic, OpenAI and GitHub header names).
+
+        GitHub headers come with every response. The Anthropic and OpenAI clients only
+        return text, so their headers are only seen on the 429 errors they raise.
+        """
+        headers = {key.lower(): value for key, value in headers.items()}
+        for kind, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            if bucket is None:
+                continue
+            limit = headers.get(f"anthropic-ratelimit-{kind}-limit") or headers.get(f"x-ratelimit-limit-{kind}")
+            if limit is not None:
+                try:
+                    bucket.set_rate(float(limit))
+                except ValueError:
+                    pass
+            remaining = headers.get(f"anthropic-ratelimit-{kind}-remaining") or headers.get(f"x-ratelimit-remaining-{kind}")
+            reset = headers.get(f"anthropic-ratelimit-{kind}-reset") or headers.get(f"x-ratelimit-reset-{kind}")
+            if remaining == "0":
+                bucket.drain()
+                self.pause(parse_reset(reset) or 0.0)
+        # GitHub reports an hourly window
+        if headers.get("x-ratelimit-remaining") == "0":
+            self.pause(parse_reset(headers.get("x-ratelimit-reset")) or 60.0)
+
+    def call(self, fn: Callable[[], T], tokens: int = 0, max_retries: int = MAX_RETRIES) -> T:
+        """Calls fn within the limits, retrying when the provider still says we are rate limited.
+
+        fn may return a requests response, whose headers and status are used, or raise a
+        client library exception for 429s. Clients must have their own retries turned off,
+        otherwise they retry 429s behind the limiter's back, so client exceptions for 5xx
+        responses, 529 overloaded and connection errors are retried here too.
+        """
+        for attempt in range(max_retries + 1):
+            self.acquire(tokens)
+            retry_after = None
+            try:
+                result = fn()
+            except Exception as e:
+                rate_limited = is_rate_limit_error(e)
+                if not rate_limited and not is_transient_error(e):
+                    raise
+                headers = _headers_of(e)
+                self.update_from_headers(headers)
+                if attempt == max_retries:
+                    raise
+                retry_after = parse_retry_after(headers.get("retry-after"))
+                if not rate_limited:
+                    self.on_transient_error(e, retry_after)
+                    self._count_retry()
+                    continue
+            else:
+                if not self._rate_limited_response(result) or attempt == max_retries:
+                    self.on_success()
+                    return result
+                retry_after = parse_retry_after(result.headers.get("Retry-After"))
+            self.on_rate_limited(retry_after)
+            self._count_retry()
+        raise AssertionError("unreachable")
+
+    def _count_retry(self) -> None:
+        metrics.count(f"{self.name}_retries")
+        span = metrics.current_span()
+        if span is not None:
+            span.retries += 1
+
+    def _rate_limited_response(self, result: Any) -> bool:
+        status = getattr(result, "status_code", None)
+        headers = getattr(result, "headers", None)
+        if status is None or headers is None:
+            return False
+        self.update_from_headers(headers)
+        # GitHub answers 403 rather than 429 once the primary limit is used up
+        return status == 429 or (status == 403 and headers.get("x-ratelimit-remaining") == "0")
+
+    def stats(self) -> dict:
+        return {
+            "rate_limited": self.rate_limited,
+            "transient_errors": self.transient_errors,
+            "waited_s": round(self.waited, 1),
+            "requests_per_minute": round(self.requests.rate * 60, 1),
+        }
+
+
+def _headers_of(error: Exception) -> Dict[str, str]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None) or {}
+    return {key.lower(): value for key, value in dict(headers).items()}
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Recognises 429s raised by the anthropic, openai and requests clients."""
+    for candidate in (error, getattr(error, "response", None)):
+        if getattr(candidate, "status_code", None) == 429 or getattr(candidate, "http_status", None) == 429:
+            return True
+    return "RateLimit" in type(error).__name__
+
+
+# Client exceptions for timeouts, dropped connections and unavailable servers, e.g. anthropic's
+# APIConnectionError and APITimeoutError or openai's Timeout and ServiceUnavailableError
+TRANSIENT_ERROR_NAMES = ("Connection", "Timeout", "ServiceUnavailable", "Overloaded", "InternalServer")
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Recognises 5xx responses (including Anthropic's 529 overloaded) and network errors."""
+    for candidate in (error, getattr(error, "response", None)):
+        for status in (getattr(candidate, "status_code", None), getattr(candidate, "http_status", None)):
+            if isinstance(status, int) and status >= 500:
+                return True
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    return any(name in type(error).__name__ for name in TRANSIENT_ERROR_NAMES)
+
+
+def _enabled_by_default() -> bool:
+    # Imported here because backends imports this module
+    from backends import is_offline
+
+    # Replayed and stub backends never reach a provider
+    return os.getenv("DOCIFY_RATE_LIMITS", "off" if is_offline() else "on") == "on"
+
+
+class RateLimitScheduler:
+    """One limiter per provider for the whole process."""
+
+    def __init__(self, limits: Optional[Dict[str, ProviderLimits]] = None, enabled: Optional[bool] = None) -> None:
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        # Decided when the first limiter is created, see _enabled_by_default
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._limiters: Dict[str, ProviderLimiter] = {}
+
+    def limiter(self, provider: str) -> ProviderLimiter:
+        with self._lock:
+            if self.enabled is None:
+                self.enabled = _enabled_by_default()
+            if provider not in self._limiters:
+                limits = self.limits.get(provider, ProviderLimits(requests_per_minute=60))
+                rpm = os.getenv(f"{provider.upper()}_RPM")
+                tpm = os.getenv(f"{provider.upper()}_TPM")
+                limits = ProviderLimits(
+                    requests_per_minute=float(rpm) if rpm else limits.requests_per_minute,
+                    tokens_per_minute=float(tpm) if tpm else limits.tokens_per_minute,
+                )
+                self._limiters[provider] = ProviderLimiter(provider, limits, self.enabled)
+            return self._limiters[provider]
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            return {name: limiter.stats() for name, limiter in self._limiters.items()}
+
+
+rate_limits = RateLimitScheduler()
@@ -0,0 +1,204 @@
+import logging
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from llama_index.retrievers import VectorIndexRetriever
+from llama_index.schema import NodeWithScore
+from llama_index.vector_stores.types import VectorStoreQuery, VectorStoreQueryResult
+
+from embedding import count_tokens, embed_texts, get_encoding
+from local_vector_store import MmapVectorStore
+from vector_store import get_cached_embeddings, get_index, get_vector_store
+
+logger = logging.getLogger(__name__)
+
+SIMILARITY_TOP_K = 8
+# Reference pages longer than this are cut down before being used as a retrieval query
+MAX_QUERY_TOKENS = 8000
+
+# "truncate" queries with the first half of a large page, "multi_chunk" queries with every part of it
+LARGE_PAGE_MODES = ("truncate", "multi_chunk")
+# Target size of each query when a large page is split up, and how many queries one page may use
+CHUNK_TOKENS = 1000
+MAX_CHUNKS = 8
+# Constant from the reciprocal rank fusion paper, dampens the weight of the top ranks
+RRF_K = 60
+
+HEADING_PATTERN = re.compile(r"#{1,6} ")
+# Underline of a setext heading, the style markdownify uses for h1 and h2
+SETEXT_PATTERN = re.compile(r" {0,3}(?:=+|-+)[ \t]*$")
+FENCE_PATTERN = re.compile(r" {0,3}(`{3,}|~{3,})")
+
+
+def split_sections(text: str) -> List[str]:
+    """Splits markdown before each ATX ("# Title") or setext ("Title" over "====") heading,
+    ignoring lines inside fenced code blocks."""
+    sections, current = [], []
+    fence = None
+    for line in text.splitlines(keepends=True):
+        match = FENCE_PATTERN.match(line)
+        if match:
+            marker = match.group(1)
+            if fence is None:
+                fence = marker
+            elif marker[0] == fence[0] and len(marker) >= len(fence) and not line.strip().strip(marker[0]):
+                fence = None
+        elif fence is None and HEADING_PATTERN.match(line) and current:
+            sections.append("".join(current))
+            current = []
+        elif fence is None and SETEXT_PATTERN.match(line) and current and current[-1].strip() and not HEADING_PATTERN.match(current[-1]):
+            # The heading text is the line before the underline. After a blank line "---" is a rule instead.
+            title = current.pop()
+            if current:
+                sections.append("".join(current))
+            current = [title]
+        current.append(line)
+    if current:
+        sections.append("".join(current))
+    return sections
+
+
+def get_retrieval_query(reference_doc: str) -> str:
+    if count_tokens(reference_doc) > MAX_QUERY_TOKENS:
+        logger.info("Split large reference doc")
+        return reference_doc[: len(reference_doc) // 2]
+    return reference_doc
+
+
+def split_reference_doc(reference_doc: str, chunk_tokens: int = CHUNK_TOKENS, max_chunks: int = MAX_CHUNKS) -> List[str]:
+    """Splits a page on markdown headings, packing sections into roughly equal token windows.
+
+    Returns at most max_chunks chunks. The window grows for very large pages, and the
+    smallest neighbouring chunks are merged while there are too many, but never past
+    what the embedding model accepts. Pages too large for that lose their last chunks.
+    """
+    encoding = get_encoding()
+    total_tokens = count_tokens(reference_doc)
+    window = min(max(chunk_tokens, math.ceil(total_tokens / max_chunks)), MAX_QUERY_TOKENS)
+
+    pieces = []
+    for section in split_sections(reference_doc):
+        if not section.strip():
+            continue
+        tokens = encoding.encode(section)
+        # Sections larger than the window are cut into token windows
+        pieces.extend(
+            encoding.decode(tokens[i : i + window]) for i in range(0, len(tokens), window)
+        )
+
+    chunks, sizes, current, current_tokens = [], [], [], 0
+    for piece in pieces:
+        piece_tokens = count_tokens(piece)
+        if current and current_tokens + piece_tokens > window:
+            chunks.append("".join(current))
+            sizes.append(current_tokens)
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += piece_tokens
+    if current:
+        chunks.append("".join(current))
+        sizes.append(current_tokens)
+
+    # Greedy packing can leave more than max_chunks, merge the smallest neighbours until it doesn't
+    while len(chunks) > max_chunks:
+        pairs = [i for i in range(len(chunks) - 1) if sizes[i] + sizes[i + 1] <= MAX_QUERY_TOKENS]
+        if not pairs:
+            logger.warning(f"Reference doc of {total_tokens} tokens doesn't fit in {max_chunks} queries, dropping its end")
+            del chunks[max_chunks:]
+            break
+        i = min(pairs, key=lambda i: sizes[i] + sizes[i + 1])
+        chunks[i : i + 2] = [chunks[i] + chunks[i + 1]]
+        sizes[i : i + 2] = [sizes[i] + sizes[i + 1]]
+    return chunks
+
+
+def reciprocal_rank_fusion(result_lists: List[List[NodeWithScore]], top_k: int, k: int = RRF_K) -> List[NodeWithScore]:
+    """Merges several ranked lists, dropping duplicate chunks (same node or same text)."""
+    scores: Dict[str, float] = {}
+    nodes: Dict[str, NodeWithScore] = {}
+    for results in result_lists:
+        for rank, node_with_score in enumerate(results):
+            key = node_with_score.node.get_content().strip()
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            nodes.setdefault(key, node_with_score)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [NodeWithScore(node=nodes[key].node, score=scores[key]) for key in ranked]
+
+
+def build_context(nodes_with_scores: List[NodeWithScore]) -> str:
+    return "\n\n".join(n.node.text for n in nodes_with_scores)
+
+
+class ContextRetriever:
+    """Looks up similar documentation chunks. Build one per run and share it between pages."""
+
+    def __init__(self, vector_store=None, similarity_top_k: int = SIMILARITY_TOP_K, max_concurrency: int = 8, large_page_mode: str = "multi_chunk") -> None:
+        if large_page_mode not in LARGE_PAGE_MODES:
+            raise ValueError(f"Unknown large page mode {large_page_mode}, expected one of {LARGE_PAGE_MODES}")
+        self.large_page_mode = large_page_mode
+        self.vector_store = vector_store if vector_store is not None else get_vector_store()
+        self.similarity_top_k = similarity_top_k
+        self.max_concurrency = max_concurrency
+        self.index = get_index(self.vector_store)
+        self.retriever = VectorIndexRetriever(index=self.index, similarity_top_k=similarity_top_k)
+
+    def retrieve(self, query: str) -> List[NodeWithScore]:
+        return self.retriever.retrieve(query)
+
+    def retrieve_batch(self, queries: List[str]) -> List[List[NodeWithScore]]:
+        """Embeds all queries in bulk, then runs the top-k lookups concurrently."""
+        if not queries:
+            return []
+        query_embeddings, _ = embed_texts(get_cached_embeddings(), queries)
+
+        if isinstance(self.vector_store, MmapVectorStore):
+            results = self.vector_store.query_batch(query_embeddings, self.similarity_top_k)
+        else:
+            def query(embedding):
+                return self.vector_store.query(
+                    VectorStoreQuery(query_embedding=embedding, similarity_top_k=self.similarity_top_k)
+                )
+
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                results = list(executor.map(query, query_embeddings))
+        return [self._to_nodes(result) for result in results]
+
+    def retrieve_pages(self, reference_docs: List[str]) -> List[List[NodeWithScore]]:
+        """Retrieves context for each page.
+
+        In multi_chunk mode pages over MAX_QUERY_TOKENS are queried chunk by chunk
+        and the per-chunk results are merged with reciprocal rank fusion. All queries
+        of all pages go through a single retrieve_batch call.
+        """
+        queries_per_page = []
+        for reference_doc in reference_docs:
+            if count_tokens(reference_doc) <= MAX_QUERY_TOKENS:
+                queries_per_page.append([reference_doc])
+            elif self.large_page_mode == "truncate":
+                queries_per_page.append([get_retrieval_query(reference_doc)])
+            else:
+                chunks = split_reference_doc(reference_doc)
+                logger.info(f"Split large reference doc into {len(chunks)} queries")
+                queries_per_page.append(chunks)
+
+        results = self.retrieve_batch([query for queries in queries_per_page for query in queries])
+        page_results = []
+        offset = 0
+        for queries in queries_per_page:
+            chunk_results = results[offset : offset + len(queries)]
+            offset += len(queries)
+            if len(chunk_results) == 1:
+                page_results.append(chunk_results[0])
+            else:
+                page_results.append(reciprocal_rank_fusion(chunk_results, self.similarity_top_k))
+        return page_results
+
+    @staticmethod
+    def _to_nodes(result: VectorStoreQueryResult) -> List[NodeWithScore]:
+        similarities: List[Optional[float]] = result.similarities or [None] * len(result.nodes or [])
+        return [
+            NodeWithScore(node=node, score=score)
+            for node, score in zip(result.nodes or [], similarities)
+        ]
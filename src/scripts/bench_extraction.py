@@ -0,0 +1,100 @@
+import argparse
+import glob
+import json
+import os
+import time
+import tracemalloc
+from typing import List, Optional, Tuple
+
+import markdown
+
+from crawler import WebpageCrawler, SourceType, EXTRACTION_BACKENDS
+from http_cache import HttpCache, DEFAULT_HTTP_CACHE_PATH
+
+DOCS_PAGES_DIR = "docs_pages"
+
+# Mimics the layout of a rendered docusaurus page so the extractor has to skip the chrome
+PAGE_TEMPLATE = """<!doctype html>
+<html><head><title>{title}</title><script>window.__DOCUSAURUS__ = {{}}</script></head>
+<body><nav class="navbar"><a href="/docs">Docs</a><a href="/api">API</a></nav>
+<div class="main-wrapper"><aside class="sidebar"><ul><li><a href="/docs/get_started">Get started</a></li></ul></aside>
+<main><article><div class="theme-doc-markdown markdown">{body}</div></article></main></div>
+<footer class="footer">Copyright &copy; LangChain</footer></body></html>"""
+
+
+def load_fixture_pages(docs_dir: str = DOCS_PAGES_DIR, http_cache_path: Optional[str] = DEFAULT_HTTP_CACHE_PATH) -> List[Tuple[str, str]]:
+    """Returns (name, html) pairs from docs_pages/ plus any pages saved by a previous crawl,
+    unless http_cache_path is None."""
+    pages = []
+    for path in sorted(glob.glob(os.path.join(docs_dir, "**", "*.md"), recursive=True)):
+        with open(path) as f:
+            body = markdown.markdown(f.read(), extensions=["fenced_code", "tables"])
+        pages.append((path, PAGE_TEMPLATE.format(title=os.path.basename(path), body=body)))
+
+    if http_cache_path and os.path.isfile(http_cache_path):
+        http_cache = HttpCache(http_cache_path)
+        pages.extend((url, body) for url, body in http_cache.iter_bodies() if "<article" in body)
+    return pages
+
+
+def extract_all(crawler: WebpageCrawler, pages: List[Tuple[str, str]]) -> List[str]:
+    return [crawler._html_to_markdown(crawler._extract_body(html, name)) for name, html in pages]
+
+
+def bench_backend(backend: str, pages: List[Tuple[str, str]], repeats: int) -> Tuple[dict, List[str]]:
+    crawler = WebpageCrawler(
+        source_type=SourceType.Official, use_unstructured=False, extraction_backend=backend
+    )
+    tracemalloc.start()
+    outputs = extract_all(crawler, pages)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        extract_all(crawler, pages)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "backend": backend,
+        "pages": len(pages),
+        "pages_per_sec": len(pages) * repeats / elapsed,
+        "peak_memory_bytes": peak,
+    }, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs-dir", default=DOCS_PAGES_DIR)
+    parser.add_argument("--http-cache", default=DEFAULT_HTTP_CACHE_PATH)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    pages = load_fixture_pages(args.docs_dir, args.http_cache)
+    if not pages:
+        raise SystemExit("No fixture pages found")
+
+    results = []
+    baseline_outputs = None
+    for backend in EXTRACTION_BACKENDS:
+        result, outputs = bench_backend(backend, pages, args.repeats)
+        if baseline_outputs is None:
+            baseline_outputs = outputs
+        result["mismatched_pages"] = [
+            name for (name, _), expected, actual in zip(pages, baseline_outputs, outputs) if expected != actual
+        ]
+        results.append(result)
+        print(
+            f"{backend:12} {result['pages_per_sec']:8.1f} pages/sec  "
+            f"peak {result['peak_memory_bytes'] / 1024:8.0f} KiB  "
+            f"{len(result['mismatched_pages'])} mismatched"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
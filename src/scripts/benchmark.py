@@ -0,0 +1,297 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+from langchain.prompts import PromptTemplate
+from llama_index.schema import NodeWithScore, TextNode
+from llama_index.vector_stores.types import NodeWithEmbedding, VectorStoreQuery
+
+from bench_extraction import DOCS_PAGES_DIR, load_fixture_pages
+from corpus_store import CorpusStore
+from crawler import WebpageCrawler, SourceType
+from custom_types import Source, Metadata
+from embedding import count_tokens
+from local_vector_store import MmapVectorStore
+from prompt_budget import PromptBudgeter
+from templates import TEMPLATES
+
+EMBEDDING_DIM = 1536
+SIMILARITY_TOP_K = 8
+# Relative change past which compare reports a regression
+DEFAULT_THRESHOLD = 0.1
+
+
+def metric(value: float, unit: str, higher_is_better: bool) -> dict:
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def fixture_hash(pages: List[Tuple[str, str]]) -> str:
+    """Identifies the fixture set, results are only comparable when it is the same."""
+    digest = hashlib.sha256()
+    for name, html in sorted(pages):
+        digest.update(f"{len(name)}:{name}{len(html)}:".encode("utf-8"))
+        digest.update(html.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def time_each(fn: Callable[[Any], object], items: List[Any]) -> List[float]:
+    """Duration of fn(item) for every item."""
+    durations = []
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def percentile(durations: List[float], q: float) -> float:
+    ordered = sorted(durations)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def serve_pages(pages: List[Tuple[str, str]]) -> Tuple[ThreadingHTTPServer, List[str]]:
+    """Starts a local stand-in for the docs site and returns it with the url of every page."""
+    bodies = {f"/page/{i}": html.encode("utf-8") for i, (_, html) in enumerate(pages)}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = bodies.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    return server, [f"{base}{path}" for path in bodies]
+
+
+def bench_crawl(pages: List[Tuple[str, str]], repeats: int) -> Dict[str, dict]:
+    server, urls = serve_pages(pages)
+    try:
+        crawler = WebpageCrawler(source_type=SourceType.Official, use_unstructured=False)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for url in urls:
+                crawler._html_to_markdown(crawler._get_webpage_body(url))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+    return {"crawl.pages_per_sec": metric(len(urls) * repeats / elapsed, "pages/s", True)}
+
+
+def bench_corpus(markdown_pages: List[str], corpus_size: int, lookups: int, directory: str) -> Dict[str, dict]:
+    store = CorpusStore(os.path.join(directory, "corpus.sqlite"))
+    urls = [f"https://bench.local/docs/{i}" for i in range(corpus_size)]
+    for i, url in enumerate(urls):
+        store.append(Source(url=url, content=markdown_pages[i % len(markdown_pages)], metadata=Metadata(SourceType.Official)))
+
+    rng = random.Random(0)
+    sample = [rng.choice(urls) for _ in range(lookups)]
+    durations = time_each(store.get, sample)
+    return {
+        "corpus.lookup_p50_ms": metric(percentile(durations, 0.5) * 1000, "ms", False),
+        "corpus.lookup_p95_ms": metric(percentile(durations, 0.95) * 1000, "ms", False),
+    }
+
+
+def build_local_store(markdown_pages: List[str], index_size: int, directory: str) -> MmapVectorStore:
+    """Fills a local vector store with fixture paragraphs and random vectors (the store normalises them)."""
+    paragraphs = [p for page in markdown_pages for p in page.split("\n\n") if p.strip()]
+    store = MmapVectorStore(os.path.join(directory, "local_index"))
+    rng = np.random.default_rng(0)
+    for offset in range(0, index_size, 1000):
+        count = min(1000, index_size - offset)
+        vectors = rng.standard_normal((count, EMBEDDING_DIM), dtype=np.float32)
+        store.add([
+            NodeWithEmbedding(
+                node=TextNode(text=paragraphs[(offset + i) % len(paragraphs)], id_=f"bench-{offset + i}"),
+                embedding=vector.tolist(),
+            )
+            for i, vector in enumerate(vectors)
+        ])
+    return store
+
+
+def bench_retrieval(store: MmapVectorStore, queries: int) -> Tuple[Dict[str, dict], List[NodeWithScore]]:
+    rng = np.random.default_rng(1)
+    query_embeddings = rng.standard_normal((queries, EMBEDDING_DIM), dtype=np.float32).tolist()
+
+    durations = time_each(
+        lambda embedding: store.query(VectorStoreQuery(query_embedding=embedding, similarity_top_k=SIMILARITY_TOP_K)),
+        query_embeddings,
+    )
+    start = time.perf_counter()
+    results = store.query_batch(query_embeddings, SIMILARITY_TOP_K)
+    batch_elapsed = time.perf_counter() - start
+
+    result = results[0]
+    nodes = [NodeWithScore(node=node, score=score) for node, score in zip(result.nodes, result.similarities)]
+    return {
+        "retrieval.query_p50_ms": metric(percentile(durations, 0.5) * 1000, "ms", False),
+        "retrieval.query_p95_ms": metric(percentile(durations, 0.95) * 1000, "ms", False),
+        "retrieval.batch_queries_per_sec": metric(queries / batch_elapsed, "queries/s", True),
+    }, nodes
+
+
+def bench_tokens(markdown_pages: List[str], repeats: int) -> Dict[str, dict]:
+    characters = sum(len(page) for page in markdown_pages)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for page in markdown_pages:
+            count_tokens(page)
+    elapsed = time.perf_counter() - start
+    return {"tokens.count_mb_per_sec": metric(characters * repeats / elapsed / 1e6, "MB/s", True)}
+
+
+def bench_prompts(markdown_pages: List[str], nodes: List[NodeWithScore], repeats: int) -> Dict[str, dict]:
+    budgeter = PromptBudgeter()
+    pack_durations = time_each(lambda _: budgeter.pack(nodes), range(repeats))
+    contexts = budgeter.pack(nodes)
+
+    prompts = [PromptTemplate.from_template(template) for template in TEMPLATES.values()]
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for page in markdown_pages:
+            for stage, prompt in zip(TEMPLATES, prompts):
+                variables = {name: page for name in prompt.input_variables}
+                if "context" in variables:
+                    variables["context"] = contexts[stage]
+                prompt.format(**variables)
+    elapsed = time.perf_counter() - start
+    return {
+        "prompts.pack_ms": metric(statistics.median(pack_durations) * 1000, "ms", False),
+        "prompts.render_per_sec": metric(len(markdown_pages) * len(prompts) * repeats / elapsed, "prompts/s", True),
+    }
+
+
+def run(args) -> None:
+    pages = load_fixture_pages(args.docs_dir, args.http_cache)
+    if not pages:
+        raise SystemExit("No fixture pages found")
+    extractor = WebpageCrawler(source_type=SourceType.Official, use_unstructured=False)
+    markdown_pages = [extractor._html_to_markdown(extractor._extract_body(html, name)) for name, html in pages]
+
+    metrics = {}
+    with tempfile.TemporaryDirectory() as directory:
+        metrics.update(bench_crawl(pages, args.repeats))
+        metrics.update(bench_corpus(markdown_pages, args.corpus_size, args.lookups, directory))
+        store = build_local_store(markdown_pages, args.index_size, directory)
+        retrieval_metrics, nodes = bench_retrieval(store, args.queries)
+        metrics.update(retrieval_metrics)
+        metrics.update(bench_tokens(markdown_pages, args.repeats))
+        metrics.update(bench_prompts(markdown_pages, nodes, args.repeats))
+
+    for name, result in metrics.items():
+        print(f"{name:36} {result['value']:12.3f} {result['unit']}")
+
+    if args.output:
+        parent_dir = os.path.dirname(args.output)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "created_at": time.time(),
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "fixture_pages": len(pages),
+                    "fixture_hash": fixture_hash(pages),
+                    "settings": settings(args),
+                    "metrics": metrics,
+                },
+                f,
+                indent=2,
+            )
+
+
+def settings(args) -> dict:
+    return {
+        "repeats": args.repeats,
+        "corpus_size": args.corpus_size,
+        "lookups": args.lookups,
+        "index_size": args.index_size,
+        "queries": args.queries,
+    }
+
+
+def compare(args) -> None:
+    with open(args.baseline) as f:
+        baseline_run = json.load(f)
+    with open(args.current) as f:
+        current_run = json.load(f)
+    # Older results without a fixture hash can't be checked, so they aren't compared either
+    if baseline_run.get("fixture_hash") != current_run.get("fixture_hash"):
+        raise SystemExit("The runs used different fixture pages, their metrics aren't comparable")
+    if baseline_run.get("settings") != current_run.get("settings"):
+        raise SystemExit("The runs used different benchmark settings, their metrics aren't comparable")
+    baseline, current = baseline_run["metrics"], current_run["metrics"]
+
+    regressions = []
+    for name in sorted(baseline.keys() & current.keys()):
+        before, after = baseline[name]["value"], current[name]["value"]
+        change = (after - before) / before if before else 0.0
+        worse = -change if current[name]["higher_is_better"] else change
+        flag = "REGRESSION" if worse > args.threshold else ""
+        if flag:
+            regressions.append(name)
+        print(f"{name:36} {before:12.3f} -> {after:12.3f} {change:+8.1%} {flag}")
+
+    if regressions:
+        print(f"{len(regressions)} metrics regressed by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks for crawling, corpus lookups, retrieval and prompt assembly. "
+        "Fixtures are the pages under docs_pages/ served from a local HTTP server."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--docs-dir", default=DOCS_PAGES_DIR)
+    run_parser.add_argument(
+        "--http-cache",
+        help="Also use the pages in this HTTP cache as fixtures. It changes with every crawl, "
+        "so only compare runs made against the same copy",
+    )
+    run_parser.add_argument("--repeats", type=int, default=20)
+    run_parser.add_argument("--corpus-size", type=int, default=2000)
+    run_parser.add_argument("--lookups", type=int, default=1000)
+    run_parser.add_argument("--index-size", type=int, default=20000)
+    run_parser.add_argument("--queries", type=int, default=200)
+    run_parser.add_argument("--output", help="Write the results as JSON to this file")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help="Flag regressions between two runs")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
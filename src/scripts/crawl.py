@@ -1,33 +1,57 @@
+import argparse
 import pickle
-import pandas as pd
 from utils import get_langchain_docs_url
-from tqdm import tqdm
-from crawler import WebpageCrawler, SourceType
-    
-def crawl():
+from async_crawler import AsyncWebpageCrawler
+from crawler import SourceType
+from http_cache import HttpCache
+from corpus_store import CorpusStore
+from crawl_checkpoint import CrawlCheckpoint
+
+def crawl(resume=False, retry_failed=False):
     langchain_paths = get_langchain_docs_url()
-    errored = []
-    urls = [*langchain_paths]
+    store = CorpusStore()
+    checkpoint = CrawlCheckpoint(resume=resume)
+
+    skip = checkpoint.done if retry_failed else checkpoint.done | checkpoint.failed
+    urls = [url for url in langchain_paths if url not in skip]
+    if resume:
+        print(f"Resuming crawl, {len(langchain_paths) - len(urls)} urls already done")
+
+    # Each page is written as soon as it is crawled instead of holding the whole site in memory
+    def on_result(url, source, error):
+        if error is not None:
+            checkpoint.record(url, str(error))
+        else:
+            store.append(source)
+            checkpoint.record(url)
 
-    sources = []
-    for url in tqdm(urls):
-        print(f"Scraping {url}...")
-        crawler = WebpageCrawler(
-            source_type=SourceType.Official, use_unstructured=False
-        )
-        try:
-            sources.append(crawler.generate_row(url))
-        except:
-            errored.append(url)
-            print(f"Error on {url}")
-            
-    # TO CSV
-    df = pd.DataFrame(sources)
-    df.to_csv("./data/data.csv", index=False)
+    crawler = AsyncWebpageCrawler(
+        source_type=SourceType.Official, http_cache=HttpCache()
+    )
+    try:
+        crawler.crawl(urls, on_result=on_result)
+    finally:
+        checkpoint.close()
 
     # Keep track of urls that errored
-    with open("./data/errored.pickle", "wb") as file:
+    errored = sorted(checkpoint.failed)
+    with open("src/data/errored.pickle", "wb") as file:
         pickle.dump(errored, file)
-    
+
+    # Index sync skips these by content hash, so they are only reported
+    print(f"{len(crawler.unchanged)} of {len(urls)} pages unchanged")
+
 if __name__ == "__main__":
-    crawl()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Only crawl urls that the previous run did not finish",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="With --resume, also retry urls that failed in the previous run",
+    )
+    args = parser.parse_args()
+    crawl(resume=args.resume, retry_failed=args.retry_failed)
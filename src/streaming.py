@@ -0,0 +1,147 @@
+import logging
+import re
+import time
+from typing import Any, Optional
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+from utils import save_output
+
+logger = logging.getLogger(__name__)
+
+ANSWER_OPEN = "<answer>"
+ANSWER_CLOSE = "</answer>"
+ANSWER_PATTERN = re.compile(r"<answer>(.*?)</answer>", re.DOTALL)
+
+
+def extract_answer(response: str) -> Optional[str]:
+    """Text inside the first complete <answer> tag, tolerating stray '<' or '&'.
+
+    None when the closing tag is missing, e.g. for a completion cut off at the token limit.
+    Partial streamed output is handled by IncrementalAnswerExtractor instead.
+    """
+    match = ANSWER_PATTERN.search(response)
+    return match.group(1) if match else None
+
+
+class IncrementalAnswerExtractor:
+    """Tracks the <answer> section of a response as it is streamed in.
+
+    Tags may be split across tokens, so each token is searched together with the
+    last few characters before it, and a possible partial closing tag is held back
+    until the next token arrives. Only new text is scanned, so feeding stays linear.
+    """
+
+    def __init__(self) -> None:
+        self._parts = []
+        self._length = 0
+        # End of the buffer, long enough to hold all but the last character of a tag
+        self._tail = ""
+        self._start: Optional[int] = None
+        self._end: Optional[int] = None
+        self.closed = False
+
+    @property
+    def buffer(self) -> str:
+        joined = "".join(self._parts)
+        self._parts = [joined]
+        return joined
+
+    @property
+    def answer(self) -> str:
+        """The answer text extracted so far."""
+        if self._start is None:
+            return ""
+        return self.buffer[self._start : self._end]
+
+    def feed(self, token: str) -> None:
+        # Position of the tail in the buffer
+        offset = self._length - len(self._tail)
+        self._parts.append(token)
+        self._length += len(token)
+        if self.closed:
+            return
+        text = self._tail + token
+        if self._start is None:
+            index = text.find(ANSWER_OPEN)
+            if index == -1:
+                self._tail = text[-(len(ANSWER_OPEN) - 1) :]
+                return
+            text = text[index + len(ANSWER_OPEN) :]
+            offset += index + len(ANSWER_OPEN)
+            self._start = offset
+
+        end = text.find(ANSWER_CLOSE)
+        if end != -1:
+            self._end = offset + end
+            self.closed = True
+            return
+        # Don't emit what could be the start of the closing tag
+        safe = len(text)
+        for i in range(1, len(ANSWER_CLOSE)):
+            if text.endswith(ANSWER_CLOSE[:i]):
+                safe = len(text) - i
+        self._end = offset + safe
+        self._tail = text[-(len(ANSWER_CLOSE) - 1) :]
+
+
+class StreamingOutputHandler(BaseCallbackHandler):
+    """Writes a streamed completion to disk as it arrives and records its timing.
+
+    With extract_answer set only the <answer> section is written, otherwise the whole response.
+    """
+
+    def __init__(self, stage: str, partial_path: str, extract_answer: bool = False, flush_interval: float = 1.0) -> None:
+        self.stage = stage
+        self.partial_path = partial_path
+        self.extract_answer = extract_answer
+        self.flush_interval = flush_interval
+        self.extractor = IncrementalAnswerExtractor()
+        self.start_time: Optional[float] = None
+        self.first_token_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+        self._last_flush = 0.0
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        if self.start_time is None or self.first_token_time is None:
+            return None
+        return self.first_token_time - self.start_time
+
+    @property
+    def total_time(self) -> Optional[float]:
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def _flush(self) -> None:
+        content = self.extractor.answer if self.extract_answer else self.extractor.buffer
+        save_output(self.partial_path, content)
+        self._last_flush = time.monotonic()
+
+    def _start(self) -> None:
+        # A retried call streams from the beginning again
+        self.extractor = IncrementalAnswerExtractor()
+        self.start_time = time.monotonic()
+        self.first_token_time = None
+
+    def on_chat_model_start(self, serialized: dict, messages: Any, **kwargs: Any) -> None:
+        self._start()
+
+    def on_llm_start(self, serialized: dict, prompts: Any, **kwargs: Any) -> None:
+        self._start()
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.first_token_time is None:
+            self.first_token_time = time.monotonic()
+        self.extractor.feed(token)
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self._flush()
+
+    def on_llm_end(self, response: Any, **kwargs: Any) -> None:
+        self.end_time = time.monotonic()
+        self._flush()
+        logger.info(
+            f"{self.stage}: time to first token {self.time_to_first_token or 0:.1f}s, "
+            f"total generation {self.total_time or 0:.1f}s"
+        )
@@ -163,4 +163,11 @@ Here is the draft documentation for you to review:
 Now, review the draft documentation and check if there are any symbol being used that is not imported or defined in the code sample. 
 For each symbol being used that is not imported or defined, find exact quote from the draft documentation and explain why it is not imported or defined.
 If no variable is used without imported or defined, just tell me that there are no variables used without being imported or defined.
-"""
\ No newline at end of file
+"""
+
+# Stage name -> template of the refinement chain, shared by the agent and the benchmarks
+TEMPLATES = {
+    "initial_critique": INITIAL_CRITIQUE_PAGE_TEMPLATE,
+    "improve": IMPROVE_PAGE_TEMPLATE,
+    "critique": CRITIQUE_PAGE_TEMPLATE,
+}
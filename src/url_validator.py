@@ -0,0 +1,73 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Some servers reject HEAD outright, retry those with a streamed GET
+HEAD_FALLBACK_STATUSES = {403, 405, 501}
+
+
+@dataclass
+class UrlReport:
+    live: List[str] = field(default_factory=list)
+    # url -> status code or error message
+    dead: Dict[str, str] = field(default_factory=dict)
+    # url -> final url after redirects
+    redirected: Dict[str, str] = field(default_factory=dict)
+
+    def log(self) -> None:
+        logger.info(
+            f"Validated {len(self.live) + len(self.dead)} urls: {len(self.live)} live, "
+            f"{len(self.dead)} dead, {len(self.redirected)} redirected"
+        )
+        for url, reason in self.dead.items():
+            logger.warning(f"Dead url {url}: {reason}")
+        for url, target in self.redirected.items():
+            logger.info(f"Redirected url {url} -> {target}")
+
+
+def make_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def check_url(session: requests.Session, url: str, timeout: float) -> Tuple[Optional[int], str, Optional[str]]:
+    """Returns (status code, final url, error) using HEAD, falling back to a body-less GET."""
+    try:
+        response = session.head(url, allow_redirects=True, timeout=timeout)
+        if response.status_code in HEAD_FALLBACK_STATUSES:
+            response = session.get(url, allow_redirects=True, timeout=timeout, stream=True)
+            response.close()
+        return response.status_code, response.url, None
+    except requests.RequestException as e:
+        return None, url, str(e)
+
+
+def validate_urls(urls: List[str], max_workers: int = 16, timeout: float = 10) -> UrlReport:
+    """Checks that every url resolves, sharing one keep-alive connection pool."""
+    report = UrlReport()
+    if not urls:
+        return report
+
+    with make_session(max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda url: check_url(session, url, timeout), urls)
+        for url, (status, final_url, error) in zip(urls, results):
+            if error is not None:
+                report.dead[url] = error
+            elif status != 200:
+                report.dead[url] = str(status)
+            else:
+                report.live.append(url)
+                if final_url.rstrip("/") != url.rstrip("/"):
+                    report.redirected[url] = final_url
+
+    report.log()
+    return report
@@ -1,9 +1,29 @@
 import os
-import requests
+import json
+import logging
 
 from env_var import GITHUB_ACCESS_TOKEN
+from url_validator import validate_urls
+from http_cache import HttpCache
+from instrumentation import metrics
+from rate_limit import rate_limits
 
 LANGCHAIN_BASE = "https://python.langchain.com/docs"
+GITHUB_API_BASE = "https://api.github.com"
+DISCOVERY_CACHE_PATH = "src/data/discovery_cache.json"
+
+logger = logging.getLogger(__name__)
+
+_github_http_cache = None
+
+
+def get_github_http_cache() -> HttpCache:
+    """Created on first use, so importing utils doesn't create the cache database."""
+    global _github_http_cache
+    if _github_http_cache is None:
+        # Conditional requests that come back 304 don't count against the GitHub rate limit
+        _github_http_cache = HttpCache(limiter=rate_limits.limiter("github"))
+    return _github_http_cache
 
 
 def get_all_paths(directory):
@@ -23,40 +43,99 @@ def get_all_paths(directory):
 
     return paths
 
-def get_documentation_urls_from_github(owner: str, repo_name: str, repo_doc_root_path: str, current_path:str, rendered_doc_base_url:str):
+def get_documentation_urls_from_github(owner: str, repo_name: str, repo_doc_root_path: str, current_path:str, rendered_doc_base_url:str, validate: bool = True, api_base: str = GITHUB_API_BASE):
     paths = []    
     headers = {'Authorization': f'Bearer {GITHUB_ACCESS_TOKEN}'}
-    url = f'https://api.github.com/repos/{owner}/{repo_name}/contents/{repo_doc_root_path}/{current_path}'
-    response = requests.get(url, headers=headers)
+    url = f'{api_base}/repos/{owner}/{repo_name}/contents/{repo_doc_root_path}/{current_path}'
+    status_code, body, _ = get_github_http_cache().get(url, headers=headers)
 
-    if response.status_code == 200:
-        files = response.json()
+    if status_code == 200:
+        files = json.loads(body)
         for file in files:            
             if file['type'] == 'dir':
                 # if the file is a directory, get the files in it
                 filename = os.path.basename(file['path'])
-                paths.extend(get_documentation_urls_from_github(owner, repo_name, repo_doc_root_path, os.path.join(current_path, filename), rendered_doc_base_url))
+                paths.extend(get_documentation_urls_from_github(owner, repo_name, repo_doc_root_path, os.path.join(current_path, filename), rendered_doc_base_url, validate=False, api_base=api_base))
             elif file['name'].endswith(".mdx"):
                 rendered_doc_path = file['path'].replace(repo_doc_root_path, '').replace(".mdx", "").replace("index", "")[1:]
-                url = f"{rendered_doc_base_url}/{rendered_doc_path}"
-                response = requests.get(url)
-                if response.status_code != 200:
-                    print(f"Error hitting {url}")
-                else:
-                    paths.append(url)
+                paths.append(f"{rendered_doc_base_url}/{rendered_doc_path}")
     else:
-        print(f"Error getting document {url=} from github. Status Code: {response.status_code}. Response: {response.text}")
+        print(f"Error getting document {url=} from github. Status Code: {status_code}. Response: {body}")
+
+    if validate:
+        paths = validate_urls(paths).live
+    return paths
+
+def _github_headers():
+    return {'Authorization': f'Bearer {GITHUB_ACCESS_TOKEN}'} if GITHUB_ACCESS_TOKEN else {}
+
+def get_commit_sha(owner: str, repo_name: str, ref: str, api_base: str = GITHUB_API_BASE) -> str:
+    url = f'{api_base}/repos/{owner}/{repo_name}/commits/{ref}'
+    headers = {**_github_headers(), 'Accept': 'application/vnd.github.sha'}
+    status_code, body, _ = get_github_http_cache().get(url, headers=headers)
+    if status_code != 200:
+        raise Exception(f"Error resolving {ref} for {owner}/{repo_name}. Status Code: {status_code}. Response: {body}")
+    return body.strip()
+
+def get_documentation_urls_from_git_tree(owner: str, repo_name: str, repo_doc_root_path: str, rendered_doc_base_url: str, ref: str = "master", api_base: str = GITHUB_API_BASE, cache_path: str = DISCOVERY_CACHE_PATH, validate: bool = True):
+    """Lists the docs with a single recursive git trees request, cached per commit SHA.
+
+    Only the commit SHA is fetched when nothing changed upstream.
+    """
+    sha = get_commit_sha(owner, repo_name, ref, api_base)
+    # Validated and unvalidated listings, and listings for different sites, are cached separately
+    cache_prefix = f"{owner}/{repo_name}/{repo_doc_root_path}|{rendered_doc_base_url}|validate={validate}"
+    cache_key = f"{cache_prefix}@{sha}"
+
+    cache = {}
+    if cache_path and os.path.isfile(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    if cache_key in cache:
+        return cache[cache_key]
+
+    url = f'{api_base}/repos/{owner}/{repo_name}/git/trees/{sha}?recursive=1'
+    status_code, body, _ = get_github_http_cache().get(url, headers=_github_headers())
+    if status_code != 200:
+        raise Exception(f"Error getting git tree {url=}. Status Code: {status_code}. Response: {body}")
+    tree = json.loads(body)
+    if tree.get('truncated'):
+        # The trees endpoint caps large repositories, fall back to walking the directory
+        logger.warning(f"Git tree for {owner}/{repo_name} is truncated, falling back to the contents API")
+        return get_documentation_urls_from_github(owner, repo_name, repo_doc_root_path, "", rendered_doc_base_url, validate=validate, api_base=api_base)
+
+    paths = []
+    for entry in tree['tree']:
+        if entry['type'] != 'blob' or not entry['path'].startswith(repo_doc_root_path + '/'):
+            continue
+        if not entry['path'].endswith(".mdx"):
+            continue
+        rendered_doc_path = entry['path'].replace(repo_doc_root_path, '').replace(".mdx", "").replace("index", "")[1:]
+        paths.append(f"{rendered_doc_base_url}/{rendered_doc_path}")
+
+    if validate:
+        paths = validate_urls(paths).live
 
+    if cache_path:
+        # Only the current SHA is kept so the cache doesn't grow with every upstream commit
+        cache = {key: value for key, value in cache.items() if not key.startswith(f"{cache_prefix}@")}
+        cache[cache_key] = paths
+        save_output(cache_path, json.dumps(cache, indent=2))
     return paths
 
-def get_langchain_docs_url():
+def get_langchain_docs_url(use_git_tree: bool = True):
+    if use_git_tree:
+        return get_documentation_urls_from_git_tree('langchain-ai', 'langchain', 'docs/docs_skeleton/docs', LANGCHAIN_BASE)
     return get_documentation_urls_from_github('langchain-ai', 'langchain', 'docs/docs_skeleton/docs', "", LANGCHAIN_BASE)
 
 def save_output(output_path: str, content: str) -> None:
-    # Get the parent directory
-    parent_dir = os.path.dirname(output_path)
-    # Create the parent directory if it doesn't exist
-    os.makedirs(parent_dir, exist_ok=True)
-    # Now you can safely write to the file
-    with open(output_path, "w") as f:
-        f.write(content)
+    with metrics.span("save_output", path=output_path, chars=len(content)):
+        # Get the parent directory
+        parent_dir = os.path.dirname(output_path)
+        # Create the parent directory if it doesn't exist
+        os.makedirs(parent_dir, exist_ok=True)
+        # Write to a temporary file first so readers never see a partial page
+        tmp_path = f"{output_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, output_path)
@@ -1,5 +1,6 @@
 import logging
 import os, sys
+import threading
 from typing import Any, List
 import chromadb
 import dataclasses
@@ -14,10 +15,15 @@ from llama_index import (
 from llama_index.embeddings import OpenAIEmbedding
 from llama_index.vector_stores import ChromaVectorStore, PineconeVectorStore
 from llama_index.node_parser import SimpleNodeParser
-from langchain.embeddings import OpenAIEmbeddings
 from custom_types import Source, SourceType
-from crawler import WebpageCrawler, SourceType
-from tqdm import tqdm
+from embedding import embed_nodes
+from embedding_cache import EmbeddingCache, CachedEmbeddings
+from async_crawler import AsyncWebpageCrawler
+from http_cache import HttpCache
+from corpus_store import CorpusStore
+from index_sync import SyncState, assign_node_ids, sync_index
+from local_vector_store import MmapVectorStore
+from backends import BACKEND, EMBEDDING_MODEL, get_embeddings, is_offline, uses_cassette
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -25,22 +31,83 @@ load_dotenv()
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logging.getLogger().addHandler(logging.StreamHandler(stream=sys.stdout))
 
-# CHROMA
-chroma_config = {"client": chromadb.PersistentClient()}
-chroma_collection = chroma_config["client"].get_or_create_collection("official")
-chroma_vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-
 # PINECONE
 pinecone_config = {"environment": "us-west1-gcp-free"}
-pinecone_vector_stores = {
-    "official": PineconeVectorStore(
-        index_name="official",
-        environment=pinecone_config["environment"],
-        namespace="dev",
-    )
-}
 
-embed_model = LangchainEmbedding(OpenAIEmbeddings())
+VECTOR_STORE_BACKENDS = ("pinecone", "chroma", "local")
+# Offline backends can't reach Pinecone, so they default to the on-disk store
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "local" if is_offline() else "pinecone")
+
+# Created on first use, so importing this module doesn't create files under src/data
+# or connect to Chroma and Pinecone
+_lock = threading.Lock()
+_chroma_vector_store = None
+_pinecone_vector_store = None
+_local_vector_store = None
+_embedding_cache = None
+_cached_embeddings = None
+
+
+def get_chroma_vector_store() -> ChromaVectorStore:
+    global _chroma_vector_store
+    with _lock:
+        if _chroma_vector_store is None:
+            chroma_collection = chromadb.PersistentClient().get_or_create_collection("official")
+            _chroma_vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+        return _chroma_vector_store
+
+
+def get_pinecone_vector_store() -> PineconeVectorStore:
+    global _pinecone_vector_store
+    with _lock:
+        if _pinecone_vector_store is None:
+            _pinecone_vector_store = PineconeVectorStore(
+                index_name="official",
+                environment=pinecone_config["environment"],
+                namespace="dev",
+            )
+        return _pinecone_vector_store
+
+
+def get_local_vector_store() -> MmapVectorStore:
+    global _local_vector_store
+    with _lock:
+        if _local_vector_store is None:
+            _local_vector_store = MmapVectorStore()
+        return _local_vector_store
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _embedding_cache
+    with _lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache()
+        return _embedding_cache
+
+
+def get_cached_embeddings():
+    """OpenAI by default; DOCIFY_BACKEND selects recorded, replayed or stub embeddings instead.
+
+    Chunks that were embedded before (by text and model) are served from disk, except when
+    recording or replaying, where every request has to reach the cassette.
+    """
+    global _cached_embeddings
+    if _cached_embeddings is None:
+        embeddings = get_embeddings()
+        if not uses_cassette():
+            embeddings = CachedEmbeddings(
+                embeddings,
+                get_embedding_cache(),
+                model_name="stub" if BACKEND == "stub" else EMBEDDING_MODEL,
+            )
+        with _lock:
+            if _cached_embeddings is None:
+                _cached_embeddings = embeddings
+    return _cached_embeddings
+
+
+def get_embed_model() -> LangchainEmbedding:
+    return LangchainEmbedding(get_cached_embeddings())
 
 
 def get_urls(sources: List[Source]):
@@ -52,57 +119,109 @@ def get_contents(sources: List[Source]):
 
 
 def get_documents(sources: List[Source]):
-    return [
-        Document(text=s.content, embedding=embed_model.get_text_embedding(s.content))
-        for s in sources
-    ]
+    # Only the chunks are embedded, see create_index
+    return [Document(text=s.content, doc_id=s.url) for s in sources]
 
 
 def get_nodes(documents: List[Document]):
     parser = SimpleNodeParser()
-    nodes = parser.get_nodes_from_documents(documents)
+    return assign_node_ids(parser.get_nodes_from_documents(documents))
 
 
 def get_metadatas(sources: List[Source]):
     return [s.metadata for s in sources]
 
 
-def create_index(vector_store, sources: List[Source] = []):
+def create_index(vector_store, sources: List[Source] = [], state: SyncState = None):
     storage_context = StorageContext.from_defaults(vector_store=vector_store)
-    service_context = ServiceContext.from_defaults(embed_model=embed_model)
-    documents = get_documents(sources)
-    index = VectorStoreIndex.from_documents(
-        documents=documents,
+    service_context = ServiceContext.from_defaults(embed_model=get_embed_model())
+    nodes = get_nodes(get_documents(sources))
+    # Embed every chunk once, in batches. The index skips nodes that already have an embedding.
+    embed_nodes(get_cached_embeddings(), nodes)
+    logging.info(f"Embedding cache stats: {get_embedding_cache().stats()}")
+    index = VectorStoreIndex(
+        nodes,
         storage_context=storage_context,
         service_context=service_context,
     )
+    if state is not None:
+        state.record_index(sources, nodes)
     return index
 
 
+def get_vector_store(backend: str = VECTOR_STORE_BACKEND):
+    """Returns the "official" docs vector store for the given backend."""
+    if backend == "pinecone":
+        return get_pinecone_vector_store()
+    if backend == "chroma":
+        return get_chroma_vector_store()
+    if backend == "local":
+        return get_local_vector_store()
+    raise ValueError(f"Unknown vector store backend {backend}, expected one of {VECTOR_STORE_BACKENDS}")
+
+
 def get_index(vector_store):
-    return VectorStoreIndex.from_vector_store(vector_store=vector_store)
+    service_context = ServiceContext.from_defaults(embed_model=get_embed_model())
+    return VectorStoreIndex.from_vector_store(
+        vector_store=vector_store, service_context=service_context
+    )
 
 
-def create_official_langchain_index(vector_store):
+def create_official_langchain_index(vector_store, state_name=None):
     langchain_paths = get_langchain_docs_url()
-    errored = []
     urls = [*langchain_paths]
 
-    sources = []
-    for url in tqdm(urls):
-        print(f"Scraping {url}...")
-        crawler = WebpageCrawler(
-            source_type=SourceType.Official, use_unstructured=False
-        )
-        try:
-            sources.append(crawler.generate_row(url))
-        except Exception as e:
-            errored.append(url)
-            print(f"Error on {url}, {e}")
-
-    index = create_index(vector_store, sources)
+    crawler = AsyncWebpageCrawler(
+        source_type=SourceType.Official, http_cache=HttpCache()
+    )
+    sources, errored = crawler.crawl(urls)
+
+    # Seed the sync state so a later --sync doesn't re-add every page
+    state = SyncState(state_name) if state_name else None
+    index = create_index(vector_store, sources, state=state)
     return index
 
 
+def sync_official_langchain_index(vector_store, state_name):
+    """Upserts changed pages and deletes removed ones.
+
+    The crawled corpus provides the content and the current docs url list decides
+    which pages still exist.
+    """
+    corpus = CorpusStore()
+    sources = (s for s in corpus.iter_sources() if s.metadata.source_type == SourceType.Official)
+    return sync_index(
+        vector_store,
+        SyncState(state_name),
+        sources,
+        get_nodes=lambda batch: get_nodes(get_documents(batch)),
+        embeddings=get_cached_embeddings(),
+        live_urls=get_langchain_docs_url(),
+    )
+
+
 if __name__ == "__main__":
-    create_official_langchain_index(pinecone_vector_stores["official"])
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", choices=VECTOR_STORE_BACKENDS, default=VECTOR_STORE_BACKEND)
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Only upsert changed pages and delete removed ones instead of rebuilding the index",
+    )
+    parser.add_argument(
+        "--build-ivf",
+        type=int,
+        metavar="N_LISTS",
+        help="For the local store, build an approximate IVF index with this many lists afterwards",
+    )
+    args = parser.parse_args()
+
+    vector_store = get_vector_store(args.store)
+    if args.sync:
+        sync_official_langchain_index(vector_store, f"{args.store}_official")
+    else:
+        create_official_langchain_index(vector_store, f"{args.store}_official")
+    if args.build_ivf and args.store == "local":
+        get_local_vector_store().build_ivf(n_lists=args.build_ivf)